@@ -1,17 +1,20 @@
 #!/usr/bin/env python3
 
 import re
-import ruamel.yaml
-import hvac
+import io
+import json
+import time
+import base64
+import hashlib
 import os
 import argparse
 RawTextHelpFormatter = argparse.RawTextHelpFormatter
 import glob
 import sys
-import git
-import platform
-import subprocess
-check_call = subprocess.check_call
+import threading
+import contextlib
+import copy
+import random
 
 
 if sys.version_info[:2] < (3, 7):
@@ -28,6 +31,7 @@ def parse_args(args):
     \n
     VAULT_ADDR:     (The HTTP address of Vault, for example, http://localhost:8200)
     VAULT_TOKEN:    (The token used to authenticate with Vault)
+    VAULT_AUTH_METHOD: (approle or kubernetes to log in to Vault instead of using VAULT_TOKEN)
     """, formatter_class=RawTextHelpFormatter)
     subparsers = parser.add_subparsers(dest="action", required=True)
 
@@ -71,7 +75,7 @@ def parse_args(args):
     view.add_argument("-v", "--verbose", help="Verbose logs", const=True, nargs="?")
 
     # Edit Help
-    edit = subparsers.add_parser("edit", help="Edit decrypted YAML file. DOES NOT CLEAN UP AUTOMATICALLY.")
+    edit = subparsers.add_parser("edit", help="Edit decrypted YAML file, then write the changed secrets back to Vault and remove it")
     edit.add_argument("yaml_file", type=str, help="The YAML file to be worked on")
     edit.add_argument("-d", "--deliminator", type=str, help="The secret deliminator used when parsing. Default: \"changeme\"")
     edit.add_argument("-vt", "--vaulttemplate", type=str, help="Substring with path to vault key instead of deliminator. Default: \"VAULT:\"")
@@ -83,7 +87,7 @@ def parse_args(args):
 
     # Install Help
     install = subparsers.add_parser("install", help="Wrapper that decrypts YAML files before running helm install")
-    install.add_argument("-f", "--values", type=str, dest="yaml_file", help="The encrypted YAML file to decrypt on the fly")
+    install.add_argument("-f", "--values", type=str, dest="yaml_file", action="append", help="The encrypted YAML file to decrypt on the fly, can be repeated")
     install.add_argument("-d", "--deliminator", type=str, help="The secret deliminator used when parsing. Default: \"changeme\"")
     install.add_argument("-vt", "--vaulttemplate", type=str, help="Substring with path to vault key instead of deliminator. Default: \"VAULT:\"")
     install.add_argument("-mp", "--mountpoint", type=str, help="The Vault Mount Point Default: \"secret/data\"")
@@ -94,7 +98,7 @@ def parse_args(args):
 
     # Template Help
     template = subparsers.add_parser("template", help="Wrapper that decrypts YAML files before running helm install")
-    template.add_argument("-f", "--values", type=str, dest="yaml_file", help="The encrypted YAML file to decrypt on the fly")
+    template.add_argument("-f", "--values", type=str, dest="yaml_file", action="append", help="The encrypted YAML file to decrypt on the fly, can be repeated")
     template.add_argument("-d", "--deliminator", type=str, help="The secret deliminator used when parsing. Default: \"changeme\"")
     template.add_argument("-vt", "--vaulttemplate", type=str, help="Substring with path to vault key instead of deliminator. Default: \"VAULT:\"")
     template.add_argument("-mp", "--mountpoint", type=str, help="The Vault Mount Point Default: \"secret/data\"")
@@ -104,7 +108,7 @@ def parse_args(args):
 
     # Upgrade Help
     upgrade = subparsers.add_parser("upgrade", help="Wrapper that decrypts YAML files before running helm install")
-    upgrade.add_argument("-f", "--values", type=str, dest="yaml_file", help="The encrypted YAML file to decrypt on the fly")
+    upgrade.add_argument("-f", "--values", type=str, dest="yaml_file", action="append", help="The encrypted YAML file to decrypt on the fly, can be repeated")
     upgrade.add_argument("-d", "--deliminator", type=str, help="The secret deliminator used when parsing. Default: \"changeme\"")
     upgrade.add_argument("-vt", "--vaulttemplate", type=str, help="Substring with path to vault key instead of deliminator. Default: \"VAULT:\"")
     upgrade.add_argument("-mp", "--mountpoint", type=str, help="The Vault Mount Point Default: \"secret/data\"")
@@ -114,7 +118,7 @@ def parse_args(args):
 
     # Lint Help
     lint = subparsers.add_parser("lint", help="Wrapper that decrypts YAML files before running helm install")
-    lint.add_argument("-f", "--values", type=str, dest="yaml_file", help="The encrypted YAML file to decrypt on the fly")
+    lint.add_argument("-f", "--values", type=str, dest="yaml_file", action="append", help="The encrypted YAML file to decrypt on the fly, can be repeated")
     lint.add_argument("-d", "--deliminator", type=str, help="The secret deliminator used when parsing. Default: \"changeme\"")
     lint.add_argument("-vt", "--vaulttemplate", type=str, help="Substring with path to vault key instead of deliminator. Default: \"VAULT:\"")
     lint.add_argument("-mp", "--mountpoint", type=str, help="The Vault Mount Point Default: \"secret/data\"")
@@ -124,7 +128,7 @@ def parse_args(args):
 
     # Diff Help
     diff = subparsers.add_parser("diff", help="Wrapper that decrypts YAML files before running helm diff")
-    diff.add_argument("-f", "--values", type=str, dest="yaml_file", help="The encrypted YAML file to decrypt on the fly")
+    diff.add_argument("-f", "--values", type=str, dest="yaml_file", action="append", help="The encrypted YAML file to decrypt on the fly, can be repeated")
     diff.add_argument("-d", "--deliminator", type=str, help="The secret deliminator used when parsing. Default: \"changeme\"")
     diff.add_argument("-vt", "--vaulttemplate", type=str, help="Substring with path to vault key instead of deliminator. Default: \"VAULT:\"")
     diff.add_argument("-mp", "--mountpoint", type=str, help="The Vault Mount Point Default: \"secret/data\"")
@@ -132,6 +136,96 @@ def parse_args(args):
     diff.add_argument("-kv", "--kvversion", choices=['v1', 'v2'], type=str, help="The KV Version (v1, v2) Default: \"v1\"")
     diff.add_argument("-v", "--verbose", help="Verbose logs", const=True, nargs="?")
 
+    # Migrate Help
+    migrate = subparsers.add_parser("migrate", help="Copy one-secret-per-key values into the packed layout (one Vault secret per chart and environment)")
+    migrate.add_argument("yaml_file", type=str, help="The YAML file to be worked on")
+    migrate.add_argument("-d", "--deliminator", type=str, help="The secret deliminator used when parsing. Default: \"changeme\"")
+    migrate.add_argument("-vt", "--vaulttemplate", type=str, help="Substring with path to vault key instead of deliminator. Default: \"VAULT:\"")
+    migrate.add_argument("-mp", "--mountpoint", type=str, help="The Vault Mount Point Default: \"secret/data\"")
+    migrate.add_argument("-vp", "--vaultpath", type=str, help="The Vault Path (secret mount location in Vault). Default: \"secret/helm\"")
+    migrate.add_argument("-kv", "--kvversion", choices=['v1', 'v2'], type=str, help="The KV Version (v1, v2) Default: \"v1\"")
+    migrate.add_argument("-v", "--verbose", help="Verbose logs", const=True, nargs="?")
+    migrate.add_argument("-e", "--environment", type=str, help="Environment whose secrets to migrate")
+
+    # Batch Help
+    batch = subparsers.add_parser("batch", help="Decrypt the values of many releases at once, then run helm for each of them concurrently")
+    batch.add_argument("manifest", type=str, help="YAML file listing the releases, see Batch Mode in the README")
+    batch.add_argument("-d", "--deliminator", type=str, help="The secret deliminator used when parsing. Default: \"changeme\"")
+    batch.add_argument("-vt", "--vaulttemplate", type=str, help="Substring with path to vault key instead of deliminator. Default: \"VAULT:\"")
+    batch.add_argument("-mp", "--mountpoint", type=str, help="The Vault Mount Point Default: \"secret/data\"")
+    batch.add_argument("-vp", "--vaultpath", type=str, help="The Vault Path (secret mount location in Vault). Default: \"secret/helm\"")
+    batch.add_argument("-kv", "--kvversion", choices=['v1', 'v2'], type=str, help="The KV Version (v1, v2) Default: \"v1\"")
+    batch.add_argument("-v", "--verbose", help="Verbose logs", const=True, nargs="?")
+    batch.add_argument("-e", "--environment", type=str, help="Environment of the releases not setting their own")
+    batch.add_argument("-j", "--jobs", type=int, help="Maximum number of helm processes running at once. Default: 4")
+    batch.add_argument("--report-file", type=str, help="Write the result and timing of every release to this file, as JSON")
+
+    # Agent Help
+    agent = subparsers.add_parser("agent", help="Run a local daemon keeping a warm Vault connection and secret cache, used by the other commands while it runs")
+    agent.add_argument("-v", "--verbose", help="Verbose logs", const=True, nargs="?")
+    agent.add_argument("--socket", type=str, help="Unix socket the agent listens on, and the other commands look for. Default: \"agent.sock\" in the cache directory")
+    agent.add_argument("--agent-ttl", type=int, help="How many seconds the agent keeps a secret it read before reading it again. Default: 300")
+
+    # Snapshot Help
+    snapshot = subparsers.add_parser("snapshot", help="Read every secret a set of values files and environments use, and write them to one encrypted bundle for --snapshot")
+    snapshot.add_argument("bundle", type=str, help="The snapshot bundle to write")
+    snapshot.add_argument("-f", "--values", type=str, dest="yaml_file", action="append", required=True, help="A YAML file whose secrets to include, can be repeated")
+    snapshot.add_argument("-d", "--deliminator", type=str, help="The secret deliminator used when parsing. Default: \"changeme\"")
+    snapshot.add_argument("-vt", "--vaulttemplate", type=str, help="Substring with path to vault key instead of deliminator. Default: \"VAULT:\"")
+    snapshot.add_argument("-mp", "--mountpoint", type=str, help="The Vault Mount Point Default: \"secret/data\"")
+    snapshot.add_argument("-vp", "--vaultpath", type=str, help="The Vault Path (secret mount location in Vault). Default: \"secret/helm\"")
+    snapshot.add_argument("-kv", "--kvversion", choices=['v1', 'v2'], type=str, help="The KV Version (v1, v2) Default: \"v1\"")
+    snapshot.add_argument("-v", "--verbose", help="Verbose logs", const=True, nargs="?")
+    snapshot.add_argument("-e", "--environment", type=str, dest="environments", action="append", help="An environment whose secrets to include, can be repeated")
+    snapshot.add_argument("--transit-key", type=str, help="Encrypt the bundle with a data key protected by this Vault transit key (mount/name) instead of VAULT_SNAPSHOT_KEY")
+
+    # Secret layout in Vault
+    for subparser in [encrypt, decrypt, view, edit, install, template, upgrade, lint, diff, batch, snapshot]:
+        subparser.add_argument("--layout", choices=['split', 'packed'], type=str, help="Store each secret on its own (split) or all secrets of a chart and environment in one Vault secret (packed). Default: \"split\"")
+
+    # Offline runs from a snapshot bundle
+    for subparser in [decrypt, view, edit, install, template, upgrade, lint, diff, batch]:
+        subparser.add_argument("--snapshot", type=str, help="Read every secret from this bundle, written by helm vault snapshot, without contacting Vault")
+
+    # How decrypted values reach helm
+    for subparser in [install, template, upgrade, lint, diff, batch]:
+        subparser.add_argument("--delivery", choices=['memory', 'file'], type=str, help="Hand decrypted values to helm through in-memory files (memory) or .dec files on disk (file). Default: \"memory\", \"file\" on Windows")
+
+    # Persistent secret cache
+    for subparser in [decrypt, view, edit, install, template, upgrade, lint, diff, batch]:
+        subparser.add_argument("--cache-ttl", type=int, help="Cache secrets on disk, encrypted, for this many seconds between runs. Default: 0 (disabled)")
+        subparser.add_argument("--no-cache", action="store_true", help="Don't use the persistent secret and placeholder caches, nor a running agent, for this run")
+        subparser.add_argument("--refresh", action="store_true", help="Ignore cached secrets and store freshly read ones")
+
+    # Concurrency of Vault requests
+    for subparser in [encrypt, decrypt, view, edit, install, template, upgrade, lint, diff, migrate, batch, agent, snapshot]:
+        subparser.add_argument("--parallel", type=int, help="Maximum number of concurrent Vault requests. Default: 10")
+
+    # How secrets are substituted into the values files
+    for subparser in [decrypt, view, edit, install, template, upgrade, lint, diff, batch]:
+        subparser.add_argument("--engine", choices=['text', 'yaml'], type=str, help="Splice secrets into the original text (text), or load and dump the values files as YAML (yaml). Default: \"text\"")
+
+    # Listing the chart's secrets in Vault up front
+    for subparser in [decrypt, view, edit, install, template, upgrade, lint, diff, batch]:
+        subparser.add_argument("--prefetch", action="store_true", help="List the chart's secrets in Vault and read them before substituting, reporting secrets no placeholder uses and placeholders whose secret is missing")
+        subparser.add_argument("--prefetch-depth", type=int, help="How many folder levels below the chart's Vault path --prefetch lists. Default: 8")
+
+    # Memory-bounded processing of large and multi-document values files
+    for subparser in [encrypt, decrypt, view, edit, install, template, upgrade, lint, diff, migrate]:
+        subparser.add_argument("--stream", action="store_true", help="Read, substitute and write out one YAML document at a time, for large and multi-document values files")
+
+    # Behaviour under load, when Vault is slow to answer or rate limits
+    for subparser in [encrypt, decrypt, view, edit, install, template, upgrade, lint, diff, migrate, batch, agent, snapshot]:
+        subparser.add_argument("--retries", type=int, help="How many times a Vault request failing with a connection error, 412, 429, 502, 503 or 504 is retried. Default: 4")
+        subparser.add_argument("--rate-limit", type=float, help="Maximum Vault requests per second made by this process. Default: 0 (unlimited)")
+        subparser.add_argument("--transport", choices=['native', 'hvac'], type=str, help="Talk to Vault with the built-in HTTP client (native) or through hvac and requests (hvac), which a proxy always uses. Default: \"native\"")
+        subparser.add_argument("--balance", choices=['round-robin', 'latency'], type=str, help="How reads are spread over the performance standbys of VAULT_ADDRS: in turn (round-robin) or to the fastest (latency). Default: \"round-robin\"")
+
+    # Instrumentation, timings and counts only
+    for subparser in [encrypt, decrypt, view, edit, install, template, upgrade, lint, diff, migrate, batch, snapshot]:
+        subparser.add_argument("--profile", action="store_true", help="Print the time spent in each phase and Vault request statistics on stderr")
+        subparser.add_argument("--metrics-file", type=str, help="Write the timings and Vault request statistics to this file, in the OpenMetrics format when it ends with .prom or .om, JSON otherwise")
+
     return parser
 
 class Git:
@@ -139,26 +233,51 @@ class Git:
         self.cwd = cwd
 
     def get_git_root(self):
-        try:
-            self.git_repo = git.Repo(self.cwd, search_parent_directories=True)
-            self.git_root = self.git_repo.git.rev_parse("--show-toplevel")
-            return self.git_root
-        except Exception as ex:
-            print(f"There was an error finding the root git repository, please specify a path within the yaml file. For more information, see Vault Path Templating: https://github.com/Just-Insane/helm-vault#vault-path-templating")
-            pass
+        # Walk up to the first folder holding .git (a directory, or a file for worktrees and submodules)
+        folder = os.path.abspath(self.cwd)
+        while not os.path.exists(os.path.join(folder, ".git")):
+            parent = os.path.dirname(folder)
+            if parent == folder:
+                print(f"There was an error finding the root git repository, please specify a path within the yaml file. For more information, see Vault Path Templating: https://github.com/Just-Insane/helm-vault#vault-path-templating")
+                return None
+            folder = parent
+        self.git_root = folder
+        return self.git_root
 
 class Envs:
     def __init__(self, args):
         self.args = args
-        self.vault_addr = os.environ["VAULT_ADDR"]
+        # Runs reading from a snapshot bundle don't need Vault
+        self.snapshot = self.get_env("VAULT_SNAPSHOT", "snapshot", None) if hasattr(args, "snapshot") else None
+        self.vault_addr = os.environ["VAULT_ADDR"] if not self.snapshot else os.environ.get("VAULT_ADDR", "")
         self.vault_mount_point = self.get_env("VAULT_MOUNT_POINT", "mountpoint", "secret")
         self.vault_path = self.get_env("VAULT_PATH", "vaultpath", "secret/helm")
         self.secret_delim = self.get_env("SECRET_DELIM", "deliminator", "changeme")
         self.secret_template = self.get_env("SECRET_TEMPLATE", "vaulttemplate", "VAULT:")
         self.kvversion = self.get_env("KVVERSION", "kvversion", "v1")
         self.environment = self.get_env("NONE", "environment", "")
+        self.parallel = int(self.get_env("VAULT_PARALLEL", "parallel", 10))
+        self.layout = self.get_env("VAULT_LAYOUT", "layout", "split")
+        self.cache_ttl = int(self.get_env("VAULT_CACHE_TTL", "cache_ttl", 0))
+        self.cache_size = int(self.get_env("VAULT_CACHE_SIZE", "cache_size", 1000))
+        self.cache_dir = self.get_env("VAULT_CACHE_DIR", "cache_dir", os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "helm-vault"))
+        self.delivery = self.get_env("VAULT_DELIVERY", "delivery", "file" if sys.platform == "win32" else "memory")
+        self.metrics_file = self.get_env("VAULT_METRICS_FILE", "metrics_file", None)
+        self.engine = self.get_env("VAULT_ENGINE", "engine", "text")
+        self.retries = int(self.get_env("VAULT_RETRIES", "retries", 4))
+        self.rate_limit = float(self.get_env("VAULT_RATE_LIMIT", "rate_limit", 0))
+        self.jobs = int(self.get_env("VAULT_JOBS", "jobs", 4))
+        self.agent_socket = self.get_env("VAULT_AGENT_SOCKET", "socket", os.path.join(self.cache_dir, "agent.sock"))
+        self.agent_ttl = int(self.get_env("VAULT_AGENT_TTL", "agent_ttl", 300))
+        self.prefetch_depth = int(self.get_env("VAULT_PREFETCH_DEPTH", "prefetch_depth", 8))
+        self.transport = self.get_env("VAULT_TRANSPORT", "transport", "native")
+        self.vault_addrs = [addr.strip() for addr in self.get_env("VAULT_ADDRS", "vault_addrs", "").split(",") if addr.strip()]
+        self.balance = self.get_env("VAULT_BALANCE", "balance", "round-robin")
+        self.transit_key = self.get_env("VAULT_SNAPSHOT_TRANSIT_KEY", "transit_key", None)
+        self.auth_method = self.get_env("VAULT_AUTH_METHOD", "auth_method", "token")
+        self.auth_path = self.get_env("VAULT_AUTH_PATH", "auth_path", self.auth_method)
 
-        if platform.system() != "Windows":
+        if sys.platform != "win32":
             editor_default = "vi"
         else:
             editor_default = "notepad"
@@ -167,6 +286,7 @@ class Envs:
 
     def get_env(self, environment_var_name, arg_name, default_value):
         value = None
+        source = "DEFAULT"
 
         if environment_var_name in os.environ:
             value=os.environ[environment_var_name]
@@ -187,24 +307,1154 @@ class Envs:
 
         return value
 
+def evict_lru(directory, size):
+    # Drop the least recently used files of a cache directory beyond size, returns how many were removed
+    entries = [entry for entry in os.scandir(directory) if entry.is_file()]
+    if len(entries) <= size:
+        return 0
+    entries.sort(key=lambda entry: entry.stat().st_mtime)
+    evicted = 0
+    for entry in entries[:len(entries) - size]:
+        try:
+            os.remove(entry.path)
+            evicted += 1
+        except OSError:
+            pass
+    return evicted
+
+class SecretCache:
+    """Encrypted on-disk cache of secrets read from Vault, shared between runs.
+
+    Entries are Fernet tokens named after a hash of (address, mount point, path, KV version),
+    so neither secret values nor Vault paths are readable from the cache directory.
+    The key comes from VAULT_CACHE_KEY, or is derived from the Vault token.
+    """
+
+    def __init__(self, envs, key_material):
+        from cryptography.fernet import Fernet, InvalidToken
+
+        self.envs = envs
+        self.invalid_token = InvalidToken
+        self.fernet = Fernet(base64.urlsafe_b64encode(hashlib.sha256(f"helm-vault-cache:{key_material}".encode()).digest()))
+        self.directory = envs.cache_dir
+        self.ttl = envs.cache_ttl
+        self.size = envs.cache_size
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.evicted = 0
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+
+    def filename(self, mount_point, path, kvversion):
+        name = hashlib.sha256(f"{self.envs.vault_addr}|{mount_point}|{path}|{kvversion}".encode()).hexdigest()
+        return os.path.join(self.directory, name)
+
+    def get(self, mount_point, path, kvversion):
+        # Returns (secret, version, fresh), or None when nothing usable is cached
+        filename = self.filename(mount_point, path, kvversion)
+        try:
+            with open(filename, "rb") as cache_file:
+                token = cache_file.read()
+            entry = json.loads(self.fernet.decrypt(token))
+            age = time.time() - self.fernet.extract_timestamp(token)
+            # Recently used entries are the last to be evicted
+            os.utime(filename)
+        except (OSError, ValueError, self.invalid_token):
+            # Including an entry another run evicted since it was read
+            return None
+        return entry["secret"], entry["version"], age < self.ttl
+
+    def put(self, mount_point, path, kvversion, secret, version):
+        filename = self.filename(mount_point, path, kvversion)
+        token = self.fernet.encrypt(json.dumps(dict(secret=secret, version=version)).encode())
+        temporary = f"{filename}.{os.getpid()}.{threading.get_ident()}"
+        # The secret was read from Vault either way, a cache that can't be written to only skips storing it
+        try:
+            with os.fdopen(os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as cache_file:
+                cache_file.write(token)
+            os.replace(temporary, filename)
+        except OSError:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+
+    def evict(self):
+        self.evicted += evict_lru(self.directory, self.size)
+
+class Snapshot:
+    """Secrets read from Vault, bundled in one encrypted file by helm vault snapshot for runs without Vault.
+
+    The bundle maps (KV version, mount point, path) to the data and KV v2 version of every secret, zlib
+    compressed and encrypted with Fernet. The key is derived from VAULT_SNAPSHOT_KEY, or is a random data
+    key stored encrypted by a Vault transit key, which reading the bundle then asks Vault to decrypt.
+    """
+
+    MAGIC = b"helm-vault-snapshot 1\n"
+
+    def __init__(self, secrets, vault_addr, created):
+        self.secrets = secrets
+        self.vault_addr = vault_addr
+        self.created = created
+        self.hits = 0
+
+    @staticmethod
+    def key(mount_point, path, kvversion):
+        return f"{kvversion}:{mount_point}:{path}"
+
+    @classmethod
+    def from_vault(cls, vault):
+        # Every secret the run read successfully, from its cache
+        secrets = {}
+        for (mount_point, path, kvversion), future in list(vault.cache.items()):
+            if future.done() and (future.exception() is None):
+                secrets[cls.key(mount_point, path, kvversion)] = [future.result(), vault.versions.get((mount_point, path))]
+        return cls(secrets, vault.envs.vault_addr, time.time())
+
+    @staticmethod
+    def transit_key(name):
+        mount_point, _, key = name.rpartition("/")
+        return mount_point or "transit", key
+
+    @staticmethod
+    def fernet(key):
+        try:
+            from cryptography.fernet import Fernet
+        except ImportError:
+            raise Exception("Snapshots need the cryptography package") from None
+        return Fernet(key)
+
+    @staticmethod
+    def derived_key():
+        if not os.environ.get("VAULT_SNAPSHOT_KEY"):
+            raise Exception("Set VAULT_SNAPSHOT_KEY, or use a Vault transit key, to encrypt and decrypt snapshots")
+        return base64.urlsafe_b64encode(hashlib.sha256(f"helm-vault-snapshot:{os.environ['VAULT_SNAPSHOT_KEY']}".encode()).digest())
+
+    def get(self, mount_point, path, kvversion):
+        # Returns (secret, version), or None when the secret is not in the bundle
+        entry = self.secrets.get(self.key(mount_point, path, kvversion))
+        if entry is None:
+            return None
+        self.hits += 1
+        return entry[0], entry[1]
+
+    def save(self, filename, envs, vault):
+        import zlib
+        header = {}
+        if envs.transit_key:
+            data_key = os.urandom(32)
+            mount_point, key = self.transit_key(envs.transit_key)
+            header["transit"] = dict(mount_point=mount_point, key=key, ciphertext=vault.client.transit_encrypt(mount_point, key, base64.b64encode(data_key).decode()))
+            key = base64.urlsafe_b64encode(data_key)
+        else:
+            key = self.derived_key()
+        payload = zlib.compress(json.dumps(dict(vault_addr=self.vault_addr, created=self.created, secrets=self.secrets), separators=(",", ":")).encode())
+        temporary = f"{filename}.{os.getpid()}"
+        with os.fdopen(os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as bundle:
+            bundle.write(self.MAGIC + json.dumps(header).encode() + b"\n" + self.fernet(key).encrypt(payload))
+        os.replace(temporary, filename)
+
+    @classmethod
+    def load(cls, filename, vault):
+        import zlib
+        with open(filename, "rb") as bundle:
+            magic = bundle.readline()
+            header = bundle.readline()
+            token = bundle.read()
+        if magic != cls.MAGIC:
+            raise Exception(f"{filename} is not a helm-vault snapshot")
+        transit = json.loads(header).get("transit")
+        if transit is not None:
+            key = base64.urlsafe_b64encode(base64.b64decode(vault.client.transit_decrypt(transit["mount_point"], transit["key"], transit["ciphertext"])))
+        else:
+            key = cls.derived_key()
+        from cryptography.fernet import InvalidToken
+        try:
+            payload = json.loads(zlib.decompress(cls.fernet(key).decrypt(token)))
+        except InvalidToken:
+            raise Exception(f"{filename} can't be decrypted with this key") from None
+        return cls(payload["secrets"], payload["vault_addr"], payload["created"])
+
+class TokenBucket:
+    """Allows rate requests per second on average, in bursts of up to capacity, shared by every thread."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+class CircuitOpen(Exception):
+    pass
+
+def retry_after(value):
+    # Seconds to wait according to a Retry-After header, given in seconds or as an HTTP date
+    # None when the header is missing or unreadable
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    from email.utils import parsedate_to_datetime
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class SecretNotFound(Exception):
+    pass
+
+class VaultRequestError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+class RequestPolicy:
+    """Retries, rate limiting and circuit breaking of the HTTP requests made to Vault.
+
+    A request failing with a connection error or a RETRY_STATUSES response is retried up to
+    retries times, after the delay asked for by Retry-After or a jittered exponential backoff.
+    A 429 pauses the requests of every thread, not only the one that received it.
+    Once BREAKER_THRESHOLD requests in a row have failed all their attempts, the circuit opens:
+    requests fail at once for BREAKER_COOLDOWN seconds, after which one is let through to probe Vault.
+    """
+
+    RETRY_STATUSES = (412, 429, 502, 503, 504)
+    BACKOFF_BASE = 0.1
+    BACKOFF_CAP = 5.0
+    RETRY_AFTER_CAP = 30.0
+    BREAKER_THRESHOLD = 5
+    BREAKER_COOLDOWN = 10.0
+
+    def __init__(self, envs, metrics):
+        self.retries = envs.retries
+        self.verbose = envs.args.verbose is True
+        self.metrics = metrics
+        self.bucket = TokenBucket(envs.rate_limit, max(envs.parallel, 1)) if envs.rate_limit > 0 else None
+        self.lock = threading.Lock()
+        self.paused_until = 0.0
+        self.failures = 0
+        self.opened_until = 0.0
+        self.rate_limited = 0
+        self.circuit_opened = 0
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.BACKOFF_CAP, self.BACKOFF_BASE * 2 ** attempt))
+
+    def check_circuit(self):
+        with self.lock:
+            if self.failures < self.BREAKER_THRESHOLD:
+                return
+            now = time.monotonic()
+            if now < self.opened_until:
+                raise CircuitOpen(f"Vault failed {self.failures} requests in a row, not sending more for {self.opened_until - now:.0f}s")
+            # Half open: this request probes Vault, the others keep failing until it succeeds
+            self.opened_until = now + self.BREAKER_COOLDOWN
+
+    def record(self, failed):
+        with self.lock:
+            if not failed:
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.failures == self.BREAKER_THRESHOLD:
+                self.opened_until = time.monotonic() + self.BREAKER_COOLDOWN
+                self.circuit_opened += 1
+
+    def wait(self):
+        # Honour a pause asked for by Vault, then the request rate limit
+        delay = self.paused_until - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        if self.bucket is not None:
+            self.bucket.acquire()
+
+    def connection_errors(self):
+        # The native transport raises the builtin errors, requests its own once it is in use
+        errors = (ConnectionError, TimeoutError)
+        requests = sys.modules.get("requests")
+        if requests is not None:
+            errors += (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+        return errors
+
+    def send(self, send, request, **kwargs):
+        # Sends a request through send, the transport's own send
+        self.check_circuit()
+        for attempt in range(self.retries + 1):
+            self.wait()
+            try:
+                response = send(request, **kwargs)
+            except self.connection_errors() as ex:
+                if attempt == self.retries:
+                    self.record(True)
+                    raise
+                delay = self.backoff(attempt)
+                reason = type(ex).__name__
+            else:
+                status = response.status_code
+                if status not in self.RETRY_STATUSES:
+                    self.record(False)
+                    return response
+                if attempt == self.retries:
+                    self.record(True)
+                    return response
+                delay = retry_after(response.headers.get("Retry-After"))
+                delay = min(self.RETRY_AFTER_CAP, delay if delay is not None else self.backoff(attempt))
+                if status == 429:
+                    with self.lock:
+                        self.rate_limited += 1
+                        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+                response.close()
+                reason = f"HTTP {status}"
+
+            self.metrics.record_retry()
+            if self.verbose:
+                print(f"Vault request {request.method} {request.path_url} failed ({reason}), retry {attempt + 1} of {self.retries} in {delay:.2f}s")
+            time.sleep(delay)
+
+def retrying_adapter(policy, pool_maxsize):
+    # A requests transport adapter sending through policy, requests being imported on first use only
+    import requests
+
+    class RetryingAdapter(requests.adapters.HTTPAdapter):
+        def send(self, request, **kwargs):
+            return policy.send(super().send, request, **kwargs)
+
+    return RetryingAdapter(pool_maxsize=pool_maxsize)
+
+class NativeRequest:
+    def __init__(self, method, path_url, body=None):
+        self.method = method
+        self.path_url = path_url
+        self.body = body
+
+class NativeResponse:
+    def __init__(self, request, status_code, headers, content, elapsed):
+        self.request = request
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.elapsed = elapsed
+
+    def close(self):
+        pass
+
+class NativeTransport:
+    """The KV v1 and v2 calls of the plugin over plain HTTP/1.1, on the standard library only.
+
+    Every thread keeps one keep-alive connection to Vault, so a run opens at most --parallel of them.
+    Requests go through the run's RequestPolicy and are recorded in its Metrics, like with hvac.
+    TLS follows VAULT_CACERT, VAULT_CAPATH, VAULT_CLIENT_CERT and VAULT_CLIENT_KEY, as hvac does,
+    and the REQUESTS_CA_BUNDLE or CURL_CA_BUNDLE requests uses when neither VAULT_CACERT nor VAULT_CAPATH is set.
+    """
+
+    TIMEOUT = 30
+
+    def __init__(self, addr, token, policy, metrics):
+        from urllib.parse import urlsplit
+        url = urlsplit(addr)
+        self.addr = addr.rstrip("/")
+        self.https = url.scheme == "https"
+        self.host = url.hostname
+        self.port = url.port
+        self.prefix = url.path.rstrip("/")
+        self.headers = {"X-Vault-Request": "true", "Content-Type": "application/json"}
+        self.set_token(token)
+        self.policy = policy
+        self.metrics = metrics
+        self.local = threading.local()
+        self.context = None
+        if self.https:
+            import ssl
+            cafile, capath = os.environ.get("VAULT_CACERT"), os.environ.get("VAULT_CAPATH")
+            if not (cafile or capath):
+                # The CA bundle requests trusted for hvac, so a CA trusted that way still is
+                bundle = os.environ.get("REQUESTS_CA_BUNDLE") or os.environ.get("CURL_CA_BUNDLE")
+                if bundle:
+                    cafile, capath = (None, bundle) if os.path.isdir(bundle) else (bundle, None)
+            self.context = ssl.create_default_context(cafile=cafile, capath=capath)
+            if os.environ.get("VAULT_CLIENT_CERT"):
+                self.context.load_cert_chain(os.environ["VAULT_CLIENT_CERT"], os.environ.get("VAULT_CLIENT_KEY"))
+
+    def set_token(self, token):
+        # Requests made before a login, or after it by the threads of the run, take the token from here
+        if token is None:
+            self.headers.pop("X-Vault-Token", None)
+        else:
+            self.headers["X-Vault-Token"] = token
+
+    def connect(self, timeout=None):
+        import http.client
+        if self.https:
+            return http.client.HTTPSConnection(self.host, self.port, timeout=timeout or self.TIMEOUT, context=self.context)
+        return http.client.HTTPConnection(self.host, self.port, timeout=timeout or self.TIMEOUT)
+
+    def health(self, timeout):
+        # Status of /v1/sys/health and how long it took to answer, on a connection of its own and without retries
+        # The status is None when the node could not be reached
+        import http.client
+        connection = self.connect(timeout)
+        start = time.perf_counter()
+        try:
+            connection.request("GET", f"{self.prefix}/v1/sys/health")
+            response = connection.getresponse()
+            response.read()
+            return response.status, time.perf_counter() - start
+        except (OSError, http.client.HTTPException):
+            return None, None
+        finally:
+            connection.close()
+
+    def exchange(self, request):
+        # One request and response on this thread's connection
+        # A kept-alive connection Vault has closed in the meantime is replaced once, without counting as a retry
+        import datetime
+        import http.client
+        for _ in range(2):
+            connection = getattr(self.local, "connection", None)
+            reused = connection is not None
+            if not reused:
+                connection = self.local.connection = self.connect()
+            start = time.perf_counter()
+            try:
+                connection.request(request.method, f"{self.prefix}{request.path_url}", body=request.body, headers=self.headers)
+                response = connection.getresponse()
+                content = response.read()
+            except (OSError, http.client.HTTPException) as ex:
+                connection.close()
+                self.local.connection = None
+                if reused and isinstance(ex, (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)):
+                    continue
+                raise ConnectionError(f"{ex or type(ex).__name__}, on {request.method.lower()} {self.addr}{request.path_url}") from ex
+            if response.will_close:
+                connection.close()
+                self.local.connection = None
+            return NativeResponse(request, response.status, response.headers, content, datetime.timedelta(seconds=time.perf_counter() - start))
+
+    def request(self, method, path, body=None):
+        # The JSON body of Vault's response, None for a 404 or an empty response
+        from urllib.parse import quote
+        request = NativeRequest(method, f"/v1/{quote(path.strip('/'), safe='/')}", json.dumps(body).encode() if body is not None else None)
+        response = self.policy.send(self.exchange, request)
+        self.metrics.record_response(response)
+        if response.status_code == 404:
+            return None
+        payload = json.loads(response.content) if response.content else None
+        if response.status_code >= 400:
+            errors = "; ".join((payload or {}).get("errors") or []) or f"HTTP {response.status_code}"
+            raise VaultRequestError(f"{errors}, on {method.lower()} {self.addr}{request.path_url}", response.status_code)
+        return payload
+
+    def read(self, kvversion, mount_point, path):
+        # The data of a secret and its KV v2 version
+        if kvversion == "v1":
+            response = self.request("GET", path)
+            if response is None:
+                raise SecretNotFound(f"No secret found at {path}")
+            return response.get("data", {}), None
+        response = self.request("GET", f"{mount_point}/data/{path}")
+        if response is None:
+            raise SecretNotFound(f"No secret found at {path}")
+        return response.get("data", {}).get("data", {}), response.get("data", {}).get("metadata", {}).get("version")
+
+    def write(self, kvversion, mount_point, path, secret, cas=None):
+        # Returns the KV v2 version written
+        if kvversion == "v1":
+            self.request("POST", path, secret)
+            return None
+        body = dict(data=secret) if cas is None else dict(data=secret, options=dict(cas=cas))
+        return ((self.request("POST", f"{mount_point}/data/{path}", body) or {}).get("data") or {}).get("version")
+
+    def list(self, kvversion, mount_point, path):
+        response = self.request("LIST", path if kvversion == "v1" else f"{mount_point}/metadata/{path}")
+        return None if response is None else response.get("data", {}).get("keys", [])
+
+    def current_version(self, mount_point, path):
+        response = self.request("GET", f"{mount_point}/metadata/{path}")
+        return 0 if response is None else response.get("data", {}).get("current_version", 0)
+
+    def lookup_self(self):
+        return self.request("GET", "auth/token/lookup-self")
+
+    def transit_encrypt(self, mount_point, key, plaintext):
+        return self.request("POST", f"{mount_point}/encrypt/{key}", dict(plaintext=plaintext))["data"]["ciphertext"]
+
+    def transit_decrypt(self, mount_point, key, ciphertext):
+        return self.request("POST", f"{mount_point}/decrypt/{key}", dict(ciphertext=ciphertext))["data"]["plaintext"]
+
+    def renew_self(self):
+        return self.request("POST", "auth/token/renew-self", {})
+
+    def login(self, mount_point, payload):
+        return self.request("POST", f"auth/{mount_point}/login", payload)["auth"]
+
+class BalancedTransport:
+    """NativeTransport spreading reads over the nodes of a Vault cluster listed in VAULT_ADDRS.
+
+    Nodes are told apart by /v1/sys/health: the active node answers 200, performance standbys 473,
+    and nodes answering anything else (standby, sealed, uninitialised) or nothing are left out.
+    Reads go to the performance standbys, round-robin or to the one answering fastest, and to the active
+    node when there are none. Writes, and every request of enc, migrate and edit, go to the active node.
+    A node failing a request is left out for the rest of the run, the request moving on to the next one.
+    Health checks are cached in VAULT_CACHE_DIR for HEALTH_TTL seconds.
+    """
+
+    HEALTH_TTL = 30
+    HEALTH_TIMEOUT = 2
+    ACTIVE = 200
+    PERFORMANCE_STANDBY = 473
+
+    def __init__(self, vault, token):
+        envs = vault.envs
+        self.balance = envs.balance
+        self.verbose = envs.args.verbose is True
+        self.lock = threading.Lock()
+        self.turn = 0
+        # Out of the secret cache entries it evicts
+        self.health_file = os.path.join(envs.cache_dir, "cluster", "health.json")
+
+        # The node of VAULT_ADDR shares the run's policy, the others get their own retries, rate limit and circuit breaker
+        addrs = [envs.vault_addr] + [addr for addr in envs.vault_addrs if addr != envs.vault_addr]
+        self.nodes = {}
+        for addr in addrs:
+            policy = vault.policy if addr == envs.vault_addr else RequestPolicy(envs, vault.metrics)
+            if policy not in vault.policies:
+                vault.policies.append(policy)
+            self.nodes[addr] = NativeTransport(addr, token, policy, vault.metrics)
+        self.requests = dict.fromkeys(addrs, 0)
+        self.pending = dict.fromkeys(addrs, 0)
+
+        self.status, self.latency = self.check_health(addrs)
+        active = [addr for addr in addrs if self.status.get(addr) == self.ACTIVE]
+        self.active = active[0] if active else envs.vault_addr
+        standbys = [addr for addr in addrs if self.status.get(addr) == self.PERFORMANCE_STANDBY]
+        self.readers = [self.active] if vault.args.action in ("enc", "migrate", "edit") else (standbys or [self.active])
+        if self.verbose:
+            print(f"Vault nodes: {self.active} active, reading from {', '.join(self.readers)}")
+
+    def check_health(self, addrs):
+        # Health of every node, from the cache when checked less than HEALTH_TTL seconds ago, probed concurrently otherwise
+        import concurrent.futures
+        cached = {}
+        try:
+            with open(self.health_file) as health_file:
+                cached = json.load(health_file)
+        except (OSError, ValueError):
+            pass
+        now = time.time()
+        fresh = {addr: entry for addr, entry in cached.items() if (addr in addrs) and (now - entry.get("checked", 0) < self.HEALTH_TTL)}
+        stale = [addr for addr in addrs if addr not in fresh]
+        if stale:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(stale)) as executor:
+                results = list(executor.map(lambda addr: self.nodes[addr].health(self.HEALTH_TIMEOUT), stale))
+            for addr, (status, latency) in zip(stale, results):
+                cached[addr] = fresh[addr] = dict(status=status, latency=latency, checked=now)
+            self.save_health(cached)
+        return ({addr: entry["status"] for addr, entry in fresh.items()},
+                {addr: entry["latency"] if entry["latency"] is not None else self.HEALTH_TIMEOUT for addr, entry in fresh.items()})
+
+    def save_health(self, cached):
+        try:
+            os.makedirs(os.path.dirname(self.health_file), mode=0o700, exist_ok=True)
+            temporary = f"{self.health_file}.{os.getpid()}.{threading.get_ident()}"
+            with open(temporary, "w") as health_file:
+                json.dump(cached, health_file)
+            os.replace(temporary, self.health_file)
+        except OSError:
+            pass
+
+    def fail(self, addr, ex):
+        # Leave a node out for the rest of the run, and for the next runs until it is checked again
+        with self.lock:
+            if addr not in self.readers:
+                return
+            self.readers = [reader for reader in self.readers if reader != addr]
+            self.status[addr] = None
+        if self.verbose:
+            print(f"Vault node {addr} failed, leaving it out: {ex}")
+        self.save_health({node: dict(status=status, latency=self.latency.get(node), checked=time.time()) for node, status in self.status.items()})
+
+    def pick(self, tried):
+        with self.lock:
+            candidates = [addr for addr in self.readers if addr not in tried]
+            if not candidates:
+                candidates = [self.active] if self.active not in tried else []
+            if not candidates:
+                return None
+            if self.balance == "latency":
+                # Weighted by the requests already waiting on the node, so parallel reads don't all pile on one
+                addr = min(candidates, key=lambda addr: self.latency.get(addr, 0) * (self.pending[addr] + 1))
+            else:
+                self.turn += 1
+                addr = candidates[self.turn % len(candidates)]
+            self.pending[addr] += 1
+            return addr
+
+    def read_call(self, name, *args):
+        # Send a read to a node, moving on to the next one when it can't be reached or fails with a 5xx
+        tried, error = set(), None
+        while True:
+            addr = self.pick(tried)
+            if addr is None:
+                if error is None:
+                    raise ConnectionError(f"No Vault node available among {', '.join(self.nodes)}")
+                raise error
+            tried.add(addr)
+            start = time.perf_counter()
+            try:
+                result = getattr(self.nodes[addr], name)(*args)
+            except (ConnectionError, CircuitOpen) as ex:
+                error = ex
+            except VaultRequestError as ex:
+                if (ex.status or 0) < 500:
+                    raise
+                error = ex
+            else:
+                with self.lock:
+                    self.requests[addr] += 1
+                    # Moving average of the latency, for the latency balance
+                    self.latency[addr] = 0.8 * self.latency.get(addr, 0) + 0.2 * (time.perf_counter() - start)
+                return result
+            finally:
+                # However the request ended, a missing secret or any other error included, it no longer waits on the node
+                self.done(addr)
+            self.fail(addr, error)
+
+    def done(self, addr):
+        with self.lock:
+            self.pending[addr] -= 1
+
+    def read(self, kvversion, mount_point, path):
+        return self.read_call("read", kvversion, mount_point, path)
+
+    def list(self, kvversion, mount_point, path):
+        return self.read_call("list", kvversion, mount_point, path)
+
+    def current_version(self, mount_point, path):
+        return self.read_call("current_version", mount_point, path)
+
+    def write(self, kvversion, mount_point, path, secret, cas=None):
+        with self.lock:
+            self.requests[self.active] += 1
+        return self.nodes[self.active].write(kvversion, mount_point, path, secret, cas=cas)
+
+    def lookup_self(self):
+        return self.nodes[self.active].lookup_self()
+
+    def renew_self(self):
+        return self.nodes[self.active].renew_self()
+
+    def transit_encrypt(self, mount_point, key, plaintext):
+        return self.nodes[self.active].transit_encrypt(mount_point, key, plaintext)
+
+    def transit_decrypt(self, mount_point, key, ciphertext):
+        return self.nodes[self.active].transit_decrypt(mount_point, key, ciphertext)
+
+    def login(self, mount_point, payload):
+        return self.nodes[self.active].login(mount_point, payload)
+
+    def set_token(self, token):
+        for node in self.nodes.values():
+            node.set_token(token)
+
+class HvacTransport:
+    """The calls of NativeTransport made through hvac and requests, which also handle proxies."""
+
+    def __init__(self, addr, token, policy, metrics, parallel):
+        import hvac
+        import requests
+        self.exceptions = hvac.exceptions
+        session = requests.Session()
+        session.mount(addr, retrying_adapter(policy, parallel))
+        session.hooks["response"].append(metrics.record_response)
+        self.client = hvac.Client(url=addr, token=token, session=session)
+
+    @contextlib.contextmanager
+    def errors(self):
+        try:
+            yield
+        except self.exceptions.InvalidPath as ex:
+            raise SecretNotFound(str(ex)) from None
+        except self.exceptions.VaultError as ex:
+            raise VaultRequestError(str(ex), 403 if isinstance(ex, self.exceptions.Forbidden) else None) from None
+
+    def read(self, kvversion, mount_point, path):
+        with self.errors():
+            if kvversion == "v1":
+                secret = self.client.read(path)
+                if secret is None:
+                    raise SecretNotFound(f"No secret found at {path}")
+                return secret.get("data", {}), None
+            secret = self.client.secrets.kv.v2.read_secret_version(path=path, mount_point=mount_point, raise_on_deleted_version=True)
+            return secret.get("data", {}).get("data", {}), secret.get("data", {}).get("metadata", {}).get("version")
+
+    def write(self, kvversion, mount_point, path, secret, cas=None):
+        with self.errors():
+            if kvversion == "v1":
+                self.client.write_data(path, data=secret)
+                return None
+            response = self.client.secrets.kv.v2.create_or_update_secret(path=path, secret=secret, cas=cas, mount_point=mount_point)
+            return response.get("data", {}).get("version")
+
+    def list(self, kvversion, mount_point, path):
+        try:
+            with self.errors():
+                if kvversion == "v1":
+                    response = self.client.list(path)
+                    return response.get("data", {}).get("keys", []) if response else None
+                return self.client.secrets.kv.v2.list_secrets(path=path, mount_point=mount_point).get("data", {}).get("keys", [])
+        except SecretNotFound:
+            return None
+
+    def current_version(self, mount_point, path):
+        try:
+            with self.errors():
+                return self.client.secrets.kv.v2.read_secret_metadata(path=path, mount_point=mount_point).get("data", {}).get("current_version", 0)
+        except SecretNotFound:
+            return 0
+
+    def lookup_self(self):
+        with self.errors():
+            return self.client.auth.token.lookup_self()
+
+    def transit_encrypt(self, mount_point, key, plaintext):
+        with self.errors():
+            return self.client.secrets.transit.encrypt_data(name=key, plaintext=plaintext, mount_point=mount_point)["data"]["ciphertext"]
+
+    def transit_decrypt(self, mount_point, key, ciphertext):
+        with self.errors():
+            return self.client.secrets.transit.decrypt_data(name=key, ciphertext=ciphertext, mount_point=mount_point)["data"]["plaintext"]
+
+    def renew_self(self):
+        with self.errors():
+            return self.client.auth.token.renew_self()
+
+    def login(self, mount_point, payload):
+        with self.errors():
+            return self.client.adapter.post(f"/v1/auth/{mount_point}/login", json=payload)["auth"]
+
+    def set_token(self, token):
+        self.client.token = token
+
+class Auth:
+    """Vault login with AppRole or Kubernetes (VAULT_AUTH_METHOD), for runs not given a VAULT_TOKEN.
+
+    The token is cached in VAULT_CACHE_DIR, in a file only this user can read, and the next runs reuse it
+    until less than REUSE_MARGIN of its TTL is left, so a CI job logs in once per token TTL rather than on
+    every call. keep_alive() renews it while a run lasts, and logs in again once it can't be renewed further.
+    """
+
+    METHODS = ("approle", "kubernetes")
+    KUBERNETES_TOKEN_FILE = "/var/run/secrets/kubernetes.io/serviceaccount/token"
+
+    # Fraction of the TTL a cached token must have left to be reused
+    REUSE_MARGIN = 0.1
+
+    def __init__(self, envs, vault):
+        if envs.auth_method not in self.METHODS:
+            raise Exception(f"Unknown VAULT_AUTH_METHOD {envs.auth_method}, use token, approle or kubernetes")
+        self.envs = envs
+        self.vault = vault
+        self.method = envs.auth_method
+        self.mount_point = envs.auth_path.strip("/")
+        self.role = os.environ.get("VAULT_ROLE_ID") if self.method == "approle" else os.environ.get("VAULT_ROLE")
+        if not self.role:
+            raise Exception("VAULT_AUTH_METHOD=approle needs VAULT_ROLE_ID" if self.method == "approle" else "VAULT_AUTH_METHOD=kubernetes needs VAULT_ROLE")
+        self.lock = threading.Lock()
+        self.logins = 0
+        self.renewals = 0
+        self.started = False
+        # One cached token per Vault, auth method and role, out of the secret cache entries it evicts
+        key = hashlib.sha256(f"{envs.vault_addr}|{self.method}|{self.mount_point}|{self.role}".encode()).hexdigest()[:32]
+        self.token_file = os.path.join(envs.cache_dir, "auth", f"token-{key}.json")
+        self.entry = None
+
+    def payload(self):
+        if self.method == "approle":
+            return dict(role_id=self.role, secret_id=os.environ.get("VAULT_SECRET_ID", ""))
+        with open(os.environ.get("VAULT_K8S_TOKEN_FILE") or self.KUBERNETES_TOKEN_FILE) as token_file:
+            return dict(role=self.role, jwt=token_file.read().strip())
+
+    def token(self):
+        # A cached token with enough of its TTL left, otherwise a new login
+        with self.lock:
+            if self.entry is None:
+                self.entry = self.load()
+            if (self.entry is None) or not self.usable(self.entry):
+                self.entry = self.login()
+            os.environ["VAULT_TOKEN"] = self.entry["token"]
+            return self.entry["token"]
+
+    @classmethod
+    def usable(cls, entry):
+        # Tokens without a TTL never expire
+        if not entry.get("ttl"):
+            return True
+        return entry["expires"] - time.time() > entry["ttl"] * cls.REUSE_MARGIN
+
+    def load(self):
+        try:
+            with open(self.token_file) as token_file:
+                entry = json.load(token_file)
+            return entry if entry.get("token") else None
+        except (OSError, ValueError):
+            return None
+
+    def save(self, entry):
+        # Written with owner-only permissions from the start, and replaced atomically for concurrent runs
+        try:
+            os.makedirs(os.path.dirname(self.token_file), mode=0o700, exist_ok=True)
+            temporary = f"{self.token_file}.{os.getpid()}.{threading.get_ident()}"
+            descriptor = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(descriptor, "w") as token_file:
+                json.dump(entry, token_file)
+            os.replace(temporary, self.token_file)
+        except OSError as ex:
+            print(f"Could not cache the Vault token: {ex}")
+
+    def forget(self):
+        # Drop a token Vault rejected, so the next run logs in again
+        try:
+            os.remove(self.token_file)
+        except OSError:
+            pass
+
+    def entry_for(self, auth):
+        ttl = auth.get("lease_duration") or 0
+        return dict(token=auth["client_token"], ttl=ttl, renewable=bool(auth.get("renewable")), expires=time.time() + ttl)
+
+    def login(self):
+        try:
+            auth = self.vault.transport(None).login(self.mount_point, self.payload())
+        except Exception as ex:
+            raise Exception(f"Vault login with {self.method} at auth/{self.mount_point} failed: {ex}") from None
+        self.logins += 1
+        if self.envs.args.verbose is True:
+            print(f"Logged in to Vault with {self.method}, token TTL {auth.get('lease_duration') or 0}s")
+        entry = self.entry_for(auth)
+        self.save(entry)
+        return entry
+
+    def keep_alive(self, transport):
+        # Renew the token of a running transport once half of its TTL has gone, in the background
+        with self.lock:
+            if self.started or not self.entry or not self.entry.get("ttl"):
+                return
+            self.started = True
+        threading.Thread(target=self.renew_loop, args=(transport,), daemon=True).start()
+
+    def renew_loop(self, transport):
+        while True:
+            with self.lock:
+                entry = self.entry
+            if not entry["ttl"]:
+                return
+            time.sleep(max(entry["expires"] - time.time() - entry["ttl"] / 2, 1))
+            renewed = None
+            if entry["renewable"]:
+                try:
+                    renewed = self.entry_for(transport.renew_self()["auth"])
+                    self.renewals += 1
+                except Exception as ex:
+                    print(f"Error: could not renew the Vault token, logging in again: {ex}")
+            try:
+                # A token reaching its maximum TTL comes back from renewal with less than half of it left
+                if (renewed is None) or (renewed["ttl"] < entry["ttl"] / 2):
+                    renewed = self.login()
+                    transport.set_token(renewed["token"])
+                else:
+                    self.save(renewed)
+                with self.lock:
+                    self.entry = renewed
+                    os.environ["VAULT_TOKEN"] = renewed["token"]
+            except Exception as ex:
+                print(f"Error: {ex}")
+                # Try again in a minute
+                with self.lock:
+                    self.entry = dict(entry, expires=time.time() + 60 + entry["ttl"] / 2)
+
+class Metrics:
+    """Timings and Vault request statistics of one run, for --profile and --metrics-file.
+
+    Only durations, counts and sizes are recorded: never secret values, keys or Vault paths.
+    """
+
+    # Upper bounds of the Vault request latency histogram, in seconds
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+        self.action = None
+        self.phases = {}
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.latency_buckets = [0] * len(self.BUCKETS)
+        self.latency_sum = 0.0
+        self.cache = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        # Wall time of a phase, added up when it runs more than once
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def record_response(self, response, *args, **kwargs):
+        # requests response hook, called once per HTTP request made to Vault
+        latency = response.elapsed.total_seconds()
+        body = response.request.body or b""
+        with self.lock:
+            self.requests += 1
+            self.errors += response.status_code >= 400
+            self.bytes_sent += len(body)
+            self.bytes_received += len(response.content or b"")
+            self.latency_sum += latency
+            for bucket, bound in enumerate(self.BUCKETS):
+                if latency <= bound:
+                    self.latency_buckets[bucket] += 1
+                    break
+        return response
+
+    def record_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def collect(self, vault):
+        # Cache statistics are read off the Vault session once the run is over
+        self.cache = dict(run_hits=vault.cache_hits, run_misses=vault.cache_misses)
+        if vault.agent_hits is not None:
+            self.cache.update(agent_hits=vault.agent_hits)
+        if vault.snapshot is not None:
+            self.cache.update(snapshot_hits=vault.snapshot.hits)
+        if vault.disk_cache is not None:
+            self.cache.update(disk_hits=vault.disk_cache.hits, disk_revalidated=vault.disk_cache.revalidated, disk_misses=vault.disk_cache.misses)
+
+    def as_dict(self):
+        buckets, count = {}, 0
+        for bound, observed in zip(self.BUCKETS, self.latency_buckets):
+            count += observed
+            buckets[str(bound)] = count
+        buckets["+Inf"] = self.requests
+        return dict(
+            action=self.action,
+            total_seconds=round(time.perf_counter() - self.started, 6),
+            phases={name: round(seconds, 6) for name, seconds in self.phases.items()},
+            vault=dict(
+                requests=self.requests,
+                errors=self.errors,
+                retries=self.retries,
+                bytes_sent=self.bytes_sent,
+                bytes_received=self.bytes_received,
+                latency_seconds=dict(buckets=buckets, sum=round(self.latency_sum, 6), count=self.requests),
+            ),
+            cache=self.cache,
+        )
+
+    def as_table(self):
+        metrics = self.as_dict()
+        vault = metrics["vault"]
+        lines = [f"{'Phase':<16}{'Seconds':>10}"]
+        lines += [f"{name:<16}{seconds:>10.3f}" for name, seconds in metrics["phases"].items()]
+        lines.append(f"{'total':<16}{metrics['total_seconds']:>10.3f}")
+        lines.append("")
+        lines.append(f"Vault requests: {vault['requests']} ({vault['errors']} errors, {vault['retries']} retries), {vault['bytes_sent']} bytes sent, {vault['bytes_received']} bytes received")
+        if vault["requests"]:
+            average = 1000 * vault["latency_seconds"]["sum"] / vault["requests"]
+            lines.append(f"Request latency: {average:.1f}ms average")
+            previous = 0
+            for bound, count in vault["latency_seconds"]["buckets"].items():
+                if count > previous:
+                    label = bound if bound == "+Inf" else f"{bound}s"
+                    lines.append(f"  <= {label:<8}{count - previous:>6}")
+                previous = count
+        if metrics["cache"]:
+            lines.append("Cache: " + ", ".join(f"{count} {name.replace('_', ' ')}" for name, count in metrics["cache"].items()))
+        return "\n".join(lines) + "\n"
+
+    def as_openmetrics(self):
+        metrics = self.as_dict()
+        vault = metrics["vault"]
+        labels = f'action="{metrics["action"]}"'
+        lines = ["# TYPE helm_vault_phase_seconds gauge", "# UNIT helm_vault_phase_seconds seconds"]
+        lines += [f'helm_vault_phase_seconds{{{labels},phase="{name}"}} {seconds}' for name, seconds in metrics["phases"].items()]
+        lines.append(f'helm_vault_phase_seconds{{{labels},phase="total"}} {metrics["total_seconds"]}')
+        for name in ("requests", "errors", "retries"):
+            lines += [f"# TYPE helm_vault_{name} counter", f"helm_vault_{name}_total{{{labels}}} {vault[name]}"]
+        lines += ["# TYPE helm_vault_transfer_bytes counter", "# UNIT helm_vault_transfer_bytes bytes",
+                  f'helm_vault_transfer_bytes_total{{{labels},direction="sent"}} {vault["bytes_sent"]}',
+                  f'helm_vault_transfer_bytes_total{{{labels},direction="received"}} {vault["bytes_received"]}']
+        lines += ["# TYPE helm_vault_request_duration_seconds histogram", "# UNIT helm_vault_request_duration_seconds seconds"]
+        lines += [f'helm_vault_request_duration_seconds_bucket{{{labels},le="{bound}"}} {count}' for bound, count in vault["latency_seconds"]["buckets"].items()]
+        lines += [f"helm_vault_request_duration_seconds_sum{{{labels}}} {vault['latency_seconds']['sum']}",
+                  f"helm_vault_request_duration_seconds_count{{{labels}}} {vault['latency_seconds']['count']}"]
+        if metrics["cache"]:
+            lines.append("# TYPE helm_vault_cache_lookups counter")
+            lines += [f'helm_vault_cache_lookups_total{{{labels},result="{name}"}} {count}' for name, count in metrics["cache"].items()]
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+def finish_run(args, envs, metrics, vault):
+    # Trim the persistent cache and summarise the run, once every secret has been read or written
+    # The --profile table goes to stderr, so it never mixes with view output
+    # A metrics file ending in .prom or .om is written in the OpenMetrics text format, any other as JSON
+    if vault.disk_cache is not None:
+        vault.disk_cache.evict()
+    vault.report()
+    metrics.collect(vault)
+    if getattr(args, "profile", False):
+        sys.stderr.write(metrics.as_table())
+    if envs.metrics_file:
+        with open(envs.metrics_file, "w") as metrics_file:
+            if envs.metrics_file.endswith((".prom", ".om")):
+                metrics_file.write(metrics.as_openmetrics())
+            else:
+                json.dump(metrics.as_dict(), metrics_file, indent=2)
+
 class Vault:
-    def __init__(self, args, envs):
+    def __init__(self, args, envs, metrics=None):
         self.args = args
         self.envs = envs
-        self.folder = Git(os.getcwd())
-        self.folder = self.folder.get_git_root()
-        self.folder = os.path.basename(self.folder)
+        self.metrics = metrics or Metrics()
+        self._folder = None
         self.kvversion = envs.kvversion
+        self.lookups = 0
+        self.lock = threading.Lock()
+
+        # Per-run secret cache, keyed on (mount_point, path, kvversion) and holding one Future per secret
+        self.cache = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        # KV v2 version of every secret read or written, keyed on (mount_point, path)
+        self.versions = {}
+
+        # Paths of the secrets that could not be read
+        self.failed = []
+
+        # Fields waiting to be written by flush(), keyed on (mount_point, path)
+        self.pending = {}
+
+        # Secrets of a snapshot bundle, set by load_snapshot(), are the only ones a run reading from it uses
+        self.snapshot = None
+
+        # Retries, rate limit and circuit breaker shared by every request of the run, or of a node of the cluster
+        self.policy = RequestPolicy(envs, self.metrics)
+        self.policies = [self.policy]
+
+        # The Vault client is set up on first use, so runs served by the agent never do
+        self._client = None
+        self._connected = False
+
+        # With AppRole or Kubernetes auth, the run's VAULT_TOKEN is a cached token or the result of a login
+        self.auth = None
+        if (envs.auth_method != "token") and not envs.snapshot:
+            self.auth = Auth(envs, self)
+            self.auth.token()
 
-        # Setup Vault client (hvac)
+        # Optional cache of secrets between runs
+        # Actions writing to Vault never read from it, but keep it up to date with what they write
+        self.disk_cache = None
+        self.disk_cache_reads = args.action not in ("enc", "migrate") and not getattr(args, "refresh", False)
+        if envs.cache_ttl > 0 and not getattr(args, "no_cache", False) and not envs.snapshot:
+            try:
+                self.disk_cache = SecretCache(envs, os.environ.get("VAULT_CACHE_KEY") or os.environ["VAULT_TOKEN"])
+            except ImportError:
+                print("The secret cache needs the cryptography package, continuing without it.")
+            except Exception as ex:
+                print(f"Secret cache disabled: {ex}")
+
+        # A running agent (helm vault agent) serves the reads of the run from its warm connection and cache
+        # Actions writing to Vault only tell it which secrets they changed
+        self.agent = None
+        self.agent_hits = None
+        self.agent_reads = args.action not in ("enc", "migrate")
+        if (args.action != "agent") and not getattr(args, "no_cache", False) and not envs.snapshot and AgentClient.available(envs.agent_socket):
+            self.agent = AgentClient(envs.agent_socket, envs)
+            self.agent_hits = 0
+
+    @property
+    def client(self):
+        with self.lock:
+            if not self._connected:
+                self._connected = True
+                self._client = self.connect()
+                if (self._client is not None) and (self.auth is not None):
+                    self.auth.keep_alive(self._client)
+            return self._client
+
+    def connect(self):
+        # Setup the Vault transport, its keep-alive connections are shared by every read and write of the run
+        # hvac is used when asked for, or when a proxy is configured, which only requests supports
         try:
-            self.client = hvac.Client(url=self.envs.vault_addr, token=os.environ["VAULT_TOKEN"])
+            return self.transport(self.auth.token() if self.auth is not None else os.environ["VAULT_TOKEN"])
         except KeyError:
             print("Vault not configured correctly, check VAULT_ADDR and VAULT_TOKEN env variables.")
         except Exception as ex:
             print(f"ERROR: {ex}")
+        return None
+
+    def transport(self, token):
+        proxy = any(os.environ.get(name) for name in ("HTTPS_PROXY", "https_proxy", "HTTP_PROXY", "http_proxy", "ALL_PROXY", "all_proxy"))
+        if (self.envs.transport == "native") and not proxy:
+            if self.envs.vault_addrs:
+                return BalancedTransport(self, token)
+            return NativeTransport(self.envs.vault_addr, token, self.policy, self.metrics)
+        return HvacTransport(self.envs.vault_addr, token, self.policy, self.metrics, self.envs.parallel)
+
+    @property
+    def folder(self):
+        # The git root is looked up on first use only, then reused for the rest of the run
+        with self.lock:
+            if self._folder is None:
+                with self.metrics.phase("git"):
+                    self._folder = Git(os.getcwd())
+                    self._folder = self._folder.get_git_root()
+                    self._folder = os.path.basename(self._folder)
+            return self._folder
+
+    def report(self):
+        # Summarise what sharing one client, git lookup and secret cache saved over one Vault per secret
+        if self.args.verbose is not True:
+            return
+        if self.lookups > 1:
+            print(f"Reused one Vault connection and git lookup for {self.lookups} secrets, avoided {self.lookups - 1} client setups and {self.lookups - 1} git root lookups")
+        print(f"Secret cache: {self.cache_hits} hits, {self.cache_misses} misses")
+        if self.agent_hits is not None:
+            print(f"Agent: served {self.agent_hits} secrets")
+        rate_limited = sum(policy.rate_limited for policy in self.policies)
+        circuit_opened = sum(policy.circuit_opened for policy in self.policies)
+        if self.metrics.retries or circuit_opened:
+            print(f"Vault request retries: {self.metrics.retries} ({rate_limited} rate limited), circuit breaker opened {circuit_opened} times")
+        if isinstance(self._client, BalancedTransport):
+            print("Vault node requests: " + ", ".join(f"{addr} {count}" for addr, count in self._client.requests.items()))
+        if self.disk_cache is not None:
+            disk_cache = self.disk_cache
+            lookups = disk_cache.hits + disk_cache.revalidated + disk_cache.misses
+            hit_rate = 100 * (disk_cache.hits + disk_cache.revalidated) / lookups if lookups else 0
+            print(f"Persistent cache: {disk_cache.hits} hits, {disk_cache.revalidated} revalidated, {disk_cache.misses} misses ({hit_rate:.0f}% hit rate), {disk_cache.evicted} evicted")
 
     def process_mount_point_and_path(self, full_path, path, key):
+        with self.lock:
+            self.lookups += 1
         if full_path is not None:
             _path = full_path
             if _path.startswith('/'):
@@ -218,60 +1468,509 @@ class Vault:
 
         return mount_point, _path
 
+    def locate(self, full_path, path, key, layout=None, environment=None):
+        # Returns the mount point, path and field holding a secret
+        # The packed layout keeps every deliminator secret of a chart and environment in a single Vault secret
+        layout = layout or self.envs.layout
+        if full_path is None and layout == "packed":
+            with self.lock:
+                self.lookups += 1
+            environment = self.envs.environment if environment is None else environment
+            environment = f"/{environment}" if environment else ""
+            mount_point = self.envs.vault_mount_point
+            _path = f"{self.envs.vault_path}/{self.folder}{environment}"
+            field = f"{path[len(environment):]}/{key}"[1:]
+            return mount_point, _path, field
+
+        mount_point, _path = self.process_mount_point_and_path(full_path, path, key)
+        return mount_point, _path, "value"
+
     def vault_write(self, value, path, key, full_path=None):
         # Use path from template if presents
-        mount_point, _path = self.process_mount_point_and_path(full_path, path, key)
+        mount_point, _path, field = self.locate(full_path, path, key)
+
+        # Secrets are written in bulk by flush(), once per Vault path
+        self.stage(mount_point, _path, field, value)
+
+    def vault_read(self, value, path, key, full_path=None, environment=None, failed=None):
+        # environment overrides the run's environment, and failed collects the paths that could not be read instead of self.failed
+        mount_point, _path, field = self.locate(full_path, path, key, environment=environment)
+        failed = self.failed if failed is None else failed
 
-        # Write to vault, using the correct Vault KV version
+        # Read from Vault, using the correct Vault KV version
         try:
             if self.args.verbose is True:
                 print(f"Using KV Version: {self.kvversion}")
                 print(f"Attempting to write to url: {self.envs.vault_addr}/v1/{mount_point}/data{_path}")
 
-            if self.kvversion == "v1":
-                self.client.write(_path, value=value, mount_point = mount_point)
-            elif self.kvversion == "v2":
-                self.client.secrets.kv.v2.create_or_update_secret(
-                    path=_path,
-                    secret=dict(value=value),
-                    mount_point = mount_point,
-                )
+            if (self.kvversion == "v1") or (self.kvversion == "v2"):
+                secret = self.read_secret(mount_point, _path)
+                if field in secret:
+                    value = secret[field]
+                else:
+                    # A packed secret not yet holding a key of the values file, or a secret without its field
+                    print(f"Error: No field {field} in the secret at {_path}")
+                    failed.append(_path)
             else:
                 print("Wrong KV Version specified, either v1 or v2")
-        except AttributeError:
-            print("Vault not configured correctly, check VAULT_ADDR and VAULT_TOKEN env variables.")
+                failed.append(_path)
+        except AttributeError as ex:
+            print(f"Vault not configured correctly, check VAULT_ADDR and VAULT_TOKEN env variables. {ex}")
+            failed.append(_path)
         except Exception as ex:
             print(f"Error: {ex}")
+            failed.append(_path)
+            if (self.auth is not None) and (getattr(ex, "status", None) == 403):
+                self.auth.forget()
+
+        return value
+
+    def stage(self, mount_point, path, field, value):
+        with self.lock:
+            self.pending.setdefault((mount_point, path), {})[field] = value
+
+    def flush(self):
+        # Write every staged secret concurrently, skipping those already holding the same values
+        import concurrent.futures
+        if (self.kvversion != "v1") and (self.kvversion != "v2"):
+            print("Wrong KV Version specified, either v1 or v2")
+            return
 
         if self.args.verbose is True:
-            print(f"Wrote {value} to: {_path}")
+            print(f"Using KV Version: {self.kvversion}")
 
-    def vault_read(self, value, path, key, full_path=None):
-        mount_point, _path = self.process_mount_point_and_path(full_path, path, key)
+        pending, self.pending = self.pending, {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.envs.parallel) as executor:
+            results = list(executor.map(lambda item: self.update_secret(*item[0], item[1]), pending.items()))
 
-        # Read from Vault, using the correct Vault KV version
+        if self.args.verbose is True:
+            print(f"Secrets written: {results.count('created')} created, {results.count('updated')} updated, {results.count('unchanged')} unchanged, {results.count('failed')} failed")
+        return results
+
+    def update_secret(self, mount_point, path, fields):
+        # Read, compare and write one secret
+        # KV v2 writes use check-and-set, so a secret changed by someone else since our read is re-read rather than overwritten
+        for attempt in range(3):
+            try:
+                secret = dict(self.read_secret(mount_point, path))
+                version = self.versions.get((mount_point, path))
+            except SecretNotFound:
+                secret = {}
+                version = self.fetch_version(mount_point, path) if attempt else 0
+            except AttributeError:
+                print("Vault not configured correctly, check VAULT_ADDR and VAULT_TOKEN env variables.")
+                return "failed"
+            except Exception as ex:
+                print(f"Error: {ex}")
+                return "failed"
+
+            if secret and all((field in secret) and (secret[field] == value) for field, value in fields.items()):
+                return "unchanged"
+            result = "updated" if secret else "created"
+            secret.update(fields)
+
+            if self.args.verbose is True:
+                print(f"Attempting to write to url: {self.envs.vault_addr}/v1/{mount_point}/data{path}")
+            try:
+                self.write_secret(mount_point, path, secret, cas=version)
+            except VaultRequestError as ex:
+                if "check-and-set" not in str(ex):
+                    print(f"Error: {ex}")
+                    return "failed"
+                self.forget_secret(mount_point, path)
+                self.metrics.record_retry()
+                continue
+            except Exception as ex:
+                print(f"Error: {ex}")
+                return "failed"
+
+            if self.args.verbose is True:
+                print(f"Wrote {len(fields)} fields to: {path}")
+            return result
+
+        print(f"Error: {path} kept changing while writing it, giving up")
+        return "failed"
+
+    def read_secret(self, mount_point, path):
+        # Every lookup of the same secret in this run shares the first request, even while it is still in flight
+        import concurrent.futures
+        cache_key = (mount_point, path, self.kvversion)
+        with self.lock:
+            future = self.cache.get(cache_key)
+            owner = future is None
+            if owner:
+                future = self.cache[cache_key] = concurrent.futures.Future()
+                self.cache_misses += 1
+            else:
+                self.cache_hits += 1
+
+        if owner:
+            try:
+                future.set_result(self.fetch_cached_secret(mount_point, path))
+            except Exception as ex:
+                future.set_exception(ex.with_traceback(None))
+
+        # A failed read raises a copy in every caller, as raising the shared exception would chain the caller's
+        # frames onto it, keeping the documents they reference alive for the rest of the run
+        error = future.exception()
+        if error is not None:
+            raise copy.copy(error)
+        return future.result()
+
+    def remember_missing(self, mount_point, path):
+        # Record a secret known not to exist, so reading it fails without a request
+        import concurrent.futures
+        future = concurrent.futures.Future()
+        future.set_exception(Exception(f"No secret found at {path}"))
+        with self.lock:
+            self.cache.setdefault((mount_point, path, self.kvversion), future)
+
+    def remember_secret(self, mount_point, path, secret):
+        # Keep the cache in step with what this run wrote
+        import concurrent.futures
+        future = concurrent.futures.Future()
+        future.set_result(secret)
+        with self.lock:
+            self.cache[(mount_point, path, self.kvversion)] = future
+
+    def forget_secret(self, mount_point, path):
+        with self.lock:
+            self.cache.pop((mount_point, path, self.kvversion), None)
+
+    def write_secret(self, mount_point, path, secret, cas=None):
+        # Store the secret's data in Vault, using the correct Vault KV version
+        # cas is the KV v2 version the write expects to replace, 0 when the secret must not exist yet
+        version = self.client.write(self.kvversion, mount_point, path, secret, cas=cas)
+        if self.kvversion == "v2":
+            self.versions[(mount_point, path)] = version
+        self.remember_secret(mount_point, path, secret)
+        if self.disk_cache is not None:
+            self.disk_cache.put(mount_point, path, self.kvversion, secret, self.versions.get((mount_point, path)))
+        self.agent_request(op="forget", mount_point=mount_point, path=path)
+
+    def agent_request(self, **message):
+        # The agent's response, or None when there is no usable agent and Vault has to be asked directly
+        # An agent that can't be reached, or serves another Vault or token, is not asked again in this run
+        agent = self.agent
+        if agent is None:
+            return None
         try:
+            response = agent.request(kvversion=self.kvversion, **message)
+        except (OSError, ValueError) as ex:
+            response = dict(error=str(ex), unavailable=True)
+        if response.get("unavailable"):
             if self.args.verbose is True:
-                print(f"Using KV Version: {self.kvversion}")
-                print(f"Attempting to write to url: {self.envs.vault_addr}/v1/{mount_point}/data{_path}")
+                print(f"Not using the agent at {agent.path}: {response.get('error')}")
+            self.agent = None
+            return None
+        if "error" in response:
+            raise Exception(response["error"])
+        return response
+
+    def load_snapshot(self, filename):
+        with self.metrics.phase("snapshot"):
+            self.snapshot = Snapshot.load(filename, self)
+        if self.args.verbose is True:
+            print(f"Using {len(self.snapshot.secrets)} secrets of {filename}, read from {self.snapshot.vault_addr} {time.time() - self.snapshot.created:.0f}s ago")
+
+    def snapshot_read(self, mount_point, path):
+        entry = self.snapshot.get(mount_point, path, self.kvversion)
+        if entry is None:
+            raise SecretNotFound(f"{path} is not in the snapshot")
+        if entry[1] is not None:
+            self.versions[(mount_point, path)] = entry[1]
+        return entry[0]
+
+    def fetch_cached_secret(self, mount_point, path):
+        # A snapshot bundle is the only source of the secrets of a run using one
+        if self.snapshot is not None:
+            return self.snapshot_read(mount_point, path)
+
+        # Serve from the agent when one is running
+        response = self.agent_request(op="read", mount_point=mount_point, path=path, refresh=getattr(self.args, "refresh", False)) if self.agent_reads else None
+        if response is not None:
+            with self.lock:
+                self.agent_hits += 1
+            if response.get("version") is not None:
+                self.versions[(mount_point, path)] = response["version"]
+            return response["secret"]
+
+        # Serve from the persistent cache when the entry is fresh, or older but still at the current KV v2 version
+        disk_cache = self.disk_cache
+        if disk_cache is None:
+            return self.fetch_secret(mount_point, path)
+
+        entry = disk_cache.get(mount_point, path, self.kvversion) if self.disk_cache_reads else None
+        if entry is not None:
+            secret, version, fresh = entry
+            if fresh:
+                disk_cache.hits += 1
+                self.versions[(mount_point, path)] = version
+                return secret
+            if (self.kvversion == "v2") and (version is not None) and (self.fetch_version(mount_point, path) == version):
+                disk_cache.revalidated += 1
+                self.versions[(mount_point, path)] = version
+                disk_cache.put(mount_point, path, self.kvversion, secret, version)
+                return secret
+
+        disk_cache.misses += 1
+        secret = self.fetch_secret(mount_point, path)
+        disk_cache.put(mount_point, path, self.kvversion, secret, self.versions.get((mount_point, path)))
+        return secret
+
+    def fetch_secret(self, mount_point, path):
+        # Read the secret's data from Vault, using the correct Vault KV version
+        secret, version = self.client.read(self.kvversion, mount_point, path)
+        if self.kvversion == "v2":
+            self.versions[(mount_point, path)] = version
+        return secret
+
+    def list_secrets(self, mount_point, path):
+        # Keys of a Vault folder, sub-folders ending with a slash, or None when the folder doesn't exist
+        return self.client.list(self.kvversion, mount_point, path)
 
-            if self.kvversion == "v1":
-                value = self.client.read(_path)
-                value = value.get("data", {}).get("value")
-            elif self.kvversion == "v2":
-                value = self.client.secrets.kv.v2.read_secret_version(path=_path,mount_point=mount_point)
-                value = value.get("data", {}).get("data", {}).get("value")
+    def fetch_version(self, mount_point, path):
+        # Current KV v2 version of a secret, 0 when it was never written
+        if self.snapshot is not None:
+            entry = self.snapshot.get(mount_point, path, self.kvversion)
+            return entry[1] if entry is not None else 0
+        response = self.agent_request(op="version", mount_point=mount_point, path=path) if self.agent_reads else None
+        if response is not None:
+            return response["version"]
+        return self.client.current_version(mount_point, path)
+
+def token_identity():
+    # Hash of the Vault token, so the agent can tell whether a client is authenticated as the agent is without seeing its token
+    token = os.environ.get("VAULT_TOKEN")
+    return hashlib.sha256(f"helm-vault-agent:{token}".encode()).hexdigest() if token else None
+
+class AgentClient:
+    """Connection of a run to a helm vault agent, see Agent. Each thread uses its own socket."""
+
+    def __init__(self, path, envs):
+        self.path = path
+        self.identity = dict(addr=envs.vault_addr, token=token_identity())
+        self.local = threading.local()
+
+    @staticmethod
+    def available(path):
+        import socket
+        return hasattr(socket, "AF_UNIX") and os.path.exists(path)
+
+    def request(self, **message):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            import socket
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.path)
+            connection = self.local.connection = sock.makefile("rwb")
+            sock.close()
+        connection.write(json.dumps(dict(message, **self.identity)).encode() + b"\n")
+        connection.flush()
+        line = connection.readline()
+        if not line:
+            raise ConnectionError("the agent closed the connection")
+        return json.loads(line)
+
+class Agent:
+    """Local daemon run by helm vault agent, serving secret reads to the other commands over a Unix socket.
+
+    It keeps one authenticated, pooled Vault session per KV version and an in-memory cache of the secrets
+    it read, each kept for agent_ttl seconds and evicted least recently used beyond VAULT_CACHE_SIZE entries,
+    and renews its token while it runs. Requests and responses are JSON documents, one per line.
+    """
+
+    # How often the token's TTL is checked, in seconds
+    RENEW_INTERVAL = 60
+
+    def __init__(self, args, envs, metrics=None):
+        import collections
+        self.args = args
+        self.envs = envs
+        self.metrics = metrics or Metrics()
+        self.identity = token_identity()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.vaults = {}
+        self.server = None
+
+        # (mount_point, path, kvversion) to [expiry, Future of (secret, version)], least recently used first
+        self.cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.renewals = 0
+
+    def vault(self, kvversion):
+        if kvversion not in ("v1", "v2"):
+            raise Exception("Wrong KV Version specified, either v1 or v2")
+        with self.lock:
+            if kvversion not in self.vaults:
+                envs = copy.copy(self.envs)
+                envs.kvversion = kvversion
+                envs.cache_ttl = 0
+                self.vaults[kvversion] = Vault(self.args, envs, self.metrics)
+            return self.vaults[kvversion]
+
+    def read(self, key, refresh=False):
+        # Concurrent requests for the same secret share one Vault read, like Vault.read_secret
+        import concurrent.futures
+        with self.lock:
+            entry = self.cache.get(key)
+            owner = refresh or (entry is None) or (entry[0] <= time.monotonic())
+            if owner:
+                entry = self.cache[key] = [time.monotonic() + self.envs.agent_ttl, concurrent.futures.Future()]
+                self.misses += 1
+                while len(self.cache) > self.envs.cache_size:
+                    self.cache.popitem(last=False)
             else:
-                print("Wrong KV Version specified, either v1 or v2")
-        except AttributeError as ex:
-            print(f"Vault not configured correctly, check VAULT_ADDR and VAULT_TOKEN env variables. {ex}")
+                self.hits += 1
+            self.cache.move_to_end(key)
+            future = entry[1]
+
+        if owner:
+            mount_point, path, kvversion = key
+            try:
+                vault = self.vault(kvversion)
+                secret = vault.fetch_secret(mount_point, path)
+                future.set_result((secret, vault.versions.get((mount_point, path))))
+            except Exception as ex:
+                # Failures are not cached, the next request tries again
+                with self.lock:
+                    if self.cache.get(key) is entry:
+                        del self.cache[key]
+                future.set_exception(ex.with_traceback(None))
+
+        error = future.exception()
+        if error is not None:
+            raise copy.copy(error)
+        return future.result()
+
+    def version(self, key):
+        # The version of a cached secret while it is fresh, its current version from Vault otherwise
+        with self.lock:
+            entry = self.cache.get(key)
+        if (entry is not None) and (entry[0] > time.monotonic()) and entry[1].done() and (entry[1].exception() is None):
+            return entry[1].result()[1]
+        mount_point, path, kvversion = key
+        return self.vault(kvversion).fetch_version(mount_point, path)
+
+    def forget(self, key):
+        with self.lock:
+            self.cache.pop(key, None)
+
+    def handle(self, line):
+        # Answer one request, {"op": "read" | "version" | "forget", "mount_point", "path", "kvversion", "addr", "token"}
+        # Clients of another Vault, or authenticated with another token, are told to go to Vault themselves
+        try:
+            request = json.loads(line)
+            if request.get("addr") != self.envs.vault_addr:
+                return dict(error=f"the agent serves {self.envs.vault_addr}", unavailable=True)
+            # A token from an AppRole or Kubernetes login changes each time the agent logs in again
+            identity = token_identity() if self.envs.auth_method != "token" else self.identity
+            if request.get("token") not in (None, identity):
+                return dict(error="the agent uses another Vault token", unavailable=True)
+            key = (request["mount_point"], request["path"], request["kvversion"])
+            if request.get("op") == "read":
+                secret, version = self.read(key, refresh=request.get("refresh", False))
+                return dict(secret=secret, version=version)
+            if request.get("op") == "version":
+                return dict(version=self.version(key))
+            if request.get("op") == "forget":
+                self.forget(key)
+                return dict()
+            return dict(error=f"unknown request {request.get('op')}", unavailable=True)
         except Exception as ex:
-            print(f"Error: {ex}")
+            return dict(error=str(ex))
 
-        return value
+    def renew_token(self):
+        # Renew the token once half of its TTL has gone, tokens without a TTL are left alone
+        # A token from an AppRole or Kubernetes login is renewed by its Auth instead
+        while not self.stopped.wait(self.RENEW_INTERVAL):
+            try:
+                vault = self.vault(self.envs.kvversion)
+                if vault.auth is not None:
+                    return
+                client = vault.client
+                token = client.lookup_self().get("data", {})
+                if token.get("renewable") and (token.get("ttl", 0) <= token.get("creation_ttl", 0) / 2):
+                    client.renew_self()
+                    self.renewals += 1
+                    if self.args.verbose is True:
+                        print("Renewed the agent's Vault token")
+            except Exception as ex:
+                print(f"Error: could not renew the agent's Vault token: {ex}")
+
+    def start(self):
+        # Listen on the socket, only reachable by this user, replacing a socket left behind by an agent that is gone
+        import socket
+        import socketserver
+        if not hasattr(socket, "AF_UNIX"):
+            raise Exception("The agent needs Unix domain sockets, which this platform does not have")
+        # Logs in first with AppRole or Kubernetes auth
+        vault = self.vault(self.envs.kvversion)
+        if vault.auth is not None:
+            vault.auth.keep_alive(vault.client)
+        if "VAULT_TOKEN" not in os.environ:
+            raise Exception("Vault not configured correctly, check VAULT_ADDR and VAULT_TOKEN env variables.")
+        path = self.envs.agent_socket
+        os.makedirs(os.path.dirname(os.path.abspath(path)), mode=0o700, exist_ok=True)
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+                raise Exception(f"An agent is already listening on {path}")
+            except OSError:
+                os.remove(path)
+            finally:
+                probe.close()
+
+        agent = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    self.wfile.write(json.dumps(agent.handle(line)).encode() + b"\n")
+
+        umask = os.umask(0o077)
+        try:
+            self.server = socketserver.ThreadingUnixStreamServer(path, Handler)
+        finally:
+            os.umask(umask)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.renew_token, daemon=True).start()
+        return self
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def shutdown(self):
+        self.server.shutdown()
+
+    def close(self):
+        self.stopped.set()
+        self.server.server_close()
+        if os.path.exists(self.envs.agent_socket):
+            os.remove(self.envs.agent_socket)
+
+def run_agent(args, envs, metrics):
+    # Serve until interrupted, removing the socket on the way out, SIGTERM included
+    agent = Agent(args, envs, metrics).start()
+    if threading.current_thread() is threading.main_thread():
+        import signal
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(f"Agent listening on {envs.agent_socket}")
+    try:
+        agent.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        agent.close()
+        if args.verbose is True:
+            print(f"Agent served {agent.hits} cached and {agent.misses} fresh reads, renewed its token {agent.renewals} times")
 
 def load_yaml(yaml_file):
     # Load the YAML file
+    import ruamel.yaml
     yaml = ruamel.yaml.YAML()
     yaml.preserve_quotes = True
     with open(yaml_file) as filepath:
@@ -280,19 +1979,24 @@ def load_yaml(yaml_file):
 
 def cleanup(args, envs):
     # Cleanup decrypted files
-    yaml_file = args.yaml_file
-    decode_file = '.'.join(filter(None, [yaml_file, envs.environment, 'dec']))
-    try:
-        os.remove(decode_file)
-        if args.verbose is True:
-            print(f"Deleted {decode_file}")
-            sys.exit()
-    except AttributeError:
-        for fl in glob.glob("*.dec"):
+    if args.yaml_file is None:
+        for fl in glob.glob("*.dec") + glob.glob("*.dec.manifest"):
             os.remove(fl)
             if args.verbose is True:
                 print(f"Deleted {fl}")
-                sys.exit()
+        sys.exit()
+
+    yaml_files = args.yaml_file if isinstance(args.yaml_file, list) else [args.yaml_file]
+    try:
+        for yaml_file in yaml_files:
+            decode_file = '.'.join(filter(None, [yaml_file, envs.environment, 'dec']))
+            os.remove(decode_file)
+            if os.path.exists(f"{decode_file}.manifest"):
+                os.remove(f"{decode_file}.manifest")
+            if args.verbose is True:
+                print(f"Deleted {decode_file}")
+        if args.verbose is True:
+            sys.exit()
     except Exception as ex:
         print(f"Error: {ex}")
     else:
@@ -313,40 +2017,534 @@ def value_from_path(secret_data, path):
             raise Exception(f"Missing secret value. Key {key} does not exist when retrieving value from path {path}")
     return val
 
-def dict_walker(pattern, data, args, envs, secret_data, path=None):
-    # Walk through the loaded dicts looking for the values we want
-    environment = f"/{envs.environment}" if envs.environment else ""
-
-    path = path if path is not None else environment
-    action = args.action
+def scan_placeholders(pattern, template, data, location=None, path="", index=None):
+    # One pass over the loaded tree, returning [location, key, path, template_path] for every placeholder in document order
+    # location lists the keys and list positions leading to the mapping holding the placeholder
+    location = [] if location is None else location
+    index = [] if index is None else index
     if isinstance(data, dict):
         for key, value in data.items():
-            if value == pattern or str(value).startswith(envs.secret_template):
-                if value.startswith(envs.secret_template):
-                    _full_path = value[len(envs.secret_template):].replace("{environment}", environment)
-                else:
-                    _full_path = None
-                if action == "enc":
-                    path_sans_env = path.replace(environment, '')
-                    if secret_data:
-                        data[key] = value_from_path(secret_data, f"{path_sans_env}/{key}")
-                    else:
-                        path_to_property_syntax = path_sans_env.replace("/", ".")[1:]
-                        data[key] = input(f"Input a value for {path_to_property_syntax}.{key}: ")
-                    vault = Vault(args, envs)
-                    vault.vault_write(data[key], path, key, _full_path)
-                elif (action == "dec") or (action == "view") or (action == "edit") or (action == "install") or (action == "template") or (action == "upgrade") or (action == "lint") or (action == "diff"):
-                    vault = Vault(args, envs)
-                    vault = vault.vault_read(value, path, key, _full_path)
-                    value = vault
-                    data[key] = value
-            for res in dict_walker(pattern, value, args, envs, secret_data, path=f"{path}/{key}"):
-                yield res
+            if isinstance(value, str):
+                if value == pattern:
+                    index.append([location, key, path, None])
+                elif value.startswith(template):
+                    index.append([location, key, path, value[len(template):]])
+            elif isinstance(value, (dict, list)):
+                scan_placeholders(pattern, template, value, location + [key], f"{path}/{key}", index)
     elif isinstance(data, list):
-        for item in data:
-            for res in dict_walker(pattern, item, args, envs, secret_data, path=f"{path}"):
-                yield res
+        for position, item in enumerate(data):
+            if isinstance(item, (dict, list)):
+                scan_placeholders(pattern, template, item, location + [position], path, index)
+    return index
 
+def resolve_placeholders(index, data, envs):
+    # Yields (container, key, path, full_path) for every indexed placeholder, only visiting the nodes on its location
+    environment = f"/{envs.environment}" if envs.environment else ""
+    for location, key, path, template_path in index:
+        container = data
+        for step in location:
+            container = container[step]
+        full_path = template_path.replace("{environment}", environment) if template_path is not None else None
+        yield container, key, f"{environment}{path}", full_path
+
+def dict_walker(pattern, data, envs):
+    # Walk through the loaded dicts looking for the values we want
+    # Yields (container, key, path, full_path) for every placeholder, without touching Vault
+    return resolve_placeholders(scan_placeholders(pattern, envs.secret_template, data), data, envs)
+
+def placeholder_index(yaml_file, data, envs):
+    # Placeholder index of a values file, cached on disk by the hash of its content and the placeholder syntax
+    return cached_index(yaml_file, envs, "tree", lambda: scan_placeholders(envs.secret_delim, envs.secret_template, data))
+
+def cached_index(yaml_file, envs, kind, build):
+    # An index of a values file built by build(), cached on disk by the hash of its content, the placeholder syntax and kind
+    if getattr(envs.args, "no_cache", False):
+        return build()
+
+    digest = hashlib.sha256()
+    with open(yaml_file, "rb") as source:
+        digest.update(source.read())
+    digest.update(f"\0{envs.secret_delim}\0{envs.secret_template}\0{kind}".encode())
+    directory = os.path.join(envs.cache_dir, "index")
+    index_file = os.path.join(directory, f"{digest.hexdigest()}.json")
+
+    try:
+        with open(index_file) as cached:
+            index = json.load(cached)
+        os.utime(index_file)
+        return index
+    except (OSError, ValueError):
+        pass
+
+    index = build()
+    try:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        with open(index_file, "w") as cached:
+            json.dump(index, cached)
+        evict_lru(directory, envs.cache_size)
+    except (OSError, TypeError, ValueError):
+        # Keys JSON can't hold (dates, complex keys) or an unwritable cache only cost the cache
+        pass
+    return index
+
+# Plain scalars the text engine writes without quotes, anything else becomes a double-quoted (JSON) string
+PLAIN_SCALAR = re.compile(r"[A-Za-z0-9_./][A-Za-z0-9_./@+= -]*(?<! )")
+
+# Characters YAML only accepts escaped, which JSON leaves as they are
+YAML_UNPRINTABLE = re.compile("[\x7f-\x9f\u2028\u2029\ud800-\udfff\ufffe\uffff]")
+
+# YAML resolvers by version, to tell which plain scalars load as strings
+RESOLVERS = {}
+
+def plain_scalar_is_str(value, version=None):
+    import ruamel.yaml
+    resolver = RESOLVERS.get(version) or RESOLVERS.setdefault(version, ruamel.yaml.resolver.VersionedResolver(version))
+    return resolver.resolve(ruamel.yaml.nodes.ScalarNode, value, (True, False)) == "tag:yaml.org,2002:str"
+
+def scan_spans(text, envs):
+    # Placeholder index of a values file from one YAML event parse, without building a tree
+    # Entries are [location, key, path, template_path, start, end], start and end delimiting the placeholder's source text
+    # Returns None for files the text engine can't reproduce the YAML engine's results on: several documents, anchors,
+    # aliases, tags, complex or duplicate keys, and keys that don't load as strings above a placeholder
+    import ruamel.yaml
+    from ruamel.yaml.events import AliasEvent, DocumentStartEvent, MappingStartEvent, SequenceStartEvent, ScalarEvent, CollectionEndEvent
+    if text.startswith("\ufeff"):
+        return None
+
+    def loads_as_str(event):
+        return (event.style is not None) or plain_scalar_is_str(event.value)
+
+    # Each open collection is [is_mapping, location, path, string_keys, next_key_or_position, keys_seen]
+    index, stack, documents = [], [], 0
+    try:
+        for event in ruamel.yaml.YAML(typ="safe", pure=True).parse(text):
+            if isinstance(event, DocumentStartEvent):
+                documents += 1
+                if documents > 1:
+                    return None
+                continue
+            if isinstance(event, AliasEvent) or getattr(event, "anchor", None) is not None:
+                return None
+            if isinstance(event, CollectionEndEvent):
+                stack.pop()
+                continue
+            if not isinstance(event, (MappingStartEvent, SequenceStartEvent, ScalarEvent)):
+                continue
+
+            parent = stack[-1] if stack else None
+            if parent is not None and parent[0] and parent[4] is None:
+                # A mapping key
+                if not isinstance(event, ScalarEvent) or event.tag is not None or event.value in parent[5]:
+                    return None
+                parent[5].add(event.value)
+                parent[4] = (event.value, loads_as_str(event))
+                continue
+
+            if isinstance(event, ScalarEvent):
+                if parent is not None and parent[0]:
+                    (key, string_key), parent[4] = parent[4], None
+                    value = event.value
+                    if ((value == envs.secret_delim) or value.startswith(envs.secret_template)) and loads_as_str(event):
+                        if event.tag is not None or not (parent[3] and string_key):
+                            return None
+                        template_path = None if value == envs.secret_delim else value[len(envs.secret_template):]
+                        index.append([parent[1], key, parent[2], template_path, event.start_mark.index, event.end_mark.index])
+                elif parent is not None:
+                    parent[4] += 1
+                continue
+
+            # A mapping or sequence opens, below the key or list position it is the value of
+            if event.tag is not None:
+                return None
+            if parent is None:
+                location, path, string_keys = [], "", True
+            elif parent[0]:
+                (key, string_key), parent[4] = parent[4], None
+                location, path, string_keys = parent[1] + [key], f"{parent[2]}/{key}", parent[3] and string_key
+            else:
+                location, path, string_keys = parent[1] + [parent[4]], parent[2], parent[3]
+                parent[4] += 1
+            is_mapping = isinstance(event, MappingStartEvent)
+            stack.append([is_mapping, location, path, string_keys, None if is_mapping else 0, set()])
+    except ruamel.yaml.error.YAMLError:
+        # Reported by the YAML engine, with its usual message
+        return None
+    return index
+
+def text_substitution(yaml_files, action, envs):
+    # Returns (text, index) for every values file when all of them can use the text engine, None otherwise
+    if (envs.engine != "text") or (action == "enc") or (action == "migrate"):
+        return None
+    splices = []
+    # Line endings are read and written as they are, so CRLF files come out byte for byte too
+    for yaml_file in yaml_files:
+        with open(yaml_file, newline="") as source:
+            text = source.read()
+        index = cached_index(yaml_file, envs, "text", lambda: scan_spans(text, envs))
+        if index is None:
+            if envs.args.verbose is True:
+                print(f"{yaml_file} can't be handled by the text engine, using the YAML engine")
+            return None
+        splices.append((text, index))
+    return splices
+
+def splice_placeholders(index, envs):
+    # Yields (holder, key, path, full_path) for every indexed placeholder, holder being a one entry dict standing in
+    # for the mapping holding it, so the secrets can be read and written like those of a loaded tree
+    environment = f"/{envs.environment}" if envs.environment else ""
+    for location, key, path, template_path, start, end in index:
+        holder = {key: envs.secret_delim if template_path is None else f"{envs.secret_template}{template_path}"}
+        full_path = template_path.replace("{environment}", environment) if template_path is not None else None
+        yield holder, key, f"{environment}{path}", full_path
+
+def yaml_scalar(value):
+    # YAML source for a secret: plain when it reads back as the same string with YAML 1.1 and 1.2, JSON otherwise
+    if isinstance(value, str) and PLAIN_SCALAR.fullmatch(value) and plain_scalar_is_str(value, (1, 1)) and plain_scalar_is_str(value, (1, 2)):
+        return value
+    return YAML_UNPRINTABLE.sub(lambda match: f"\\u{ord(match.group()):04x}", json.dumps(value, ensure_ascii=False))
+
+def splice_values(text, index, secrets):
+    # Replace the source text of every placeholder that was resolved, leaving the rest of the file byte for byte
+    parts, position = [], 0
+    for (location, key, path, template_path, start, end), (holder, _, _, _) in zip(index, secrets):
+        placeholder = text[start:end]
+        value = holder[key]
+        # An unresolved placeholder keeps its source text, quotes included
+        unquoted = placeholder[1:-1] if placeholder[:1] in ("'", '"') else placeholder
+        if isinstance(value, str) and (value in (placeholder, unquoted)):
+            continue
+        parts += [text[position:start], yaml_scalar(value)]
+        position = end
+    parts.append(text[position:])
+    return "".join(parts)
+
+def encrypt_secrets(secrets, envs, secret_data, vault):
+    # Prompt for (or look up) each collected secret in file order and store it in Vault
+    environment = f"/{envs.environment}" if envs.environment else ""
+    for data, key, path, full_path in secrets:
+        path_sans_env = path.replace(environment, '')
+        if secret_data:
+            data[key] = value_from_path(secret_data, f"{path_sans_env}/{key}")
+        else:
+            path_to_property_syntax = path_sans_env.replace("/", ".")[1:]
+            data[key] = input(f"Input a value for {path_to_property_syntax}.{key}: ")
+        vault.vault_write(data[key], path, key, full_path)
+
+def migrate_secrets(secrets, envs, vault):
+    # Copy one-secret-per-key values into the packed layout, writing each packed secret once
+    import concurrent.futures
+    secrets = [secret for secret in secrets if secret[3] is None]
+
+    def read(secret):
+        data, key, path, full_path = secret
+        mount_point, _path, field = vault.locate(full_path, path, key, layout="split")
+        return vault.read_secret(mount_point, _path)["value"]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=envs.parallel) as executor:
+        values = list(executor.map(read, secrets))
+    for (data, key, path, full_path), value in zip(secrets, values):
+        mount_point, _path, field = vault.locate(full_path, path, key, layout="packed")
+        vault.stage(mount_point, _path, field, value)
+    vault.flush()
+
+def decrypt_secrets(secrets, envs, vault):
+    # Fetch the collected secrets concurrently, then write them back into the tree in walk order
+    import concurrent.futures
+    def read(secret):
+        data, key, path, full_path = secret
+        return vault.vault_read(data[key], path, key, full_path)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=envs.parallel) as executor:
+        values = list(executor.map(read, secrets))
+    for (data, key, path, full_path), value in zip(secrets, values):
+        data[key] = value
+
+def process_secrets(action, secrets, envs, secret_data, vault):
+    # Store (enc), copy (migrate) or read (everything else) the collected secrets
+    if action == "enc":
+        encrypt_secrets(secrets, envs, secret_data, vault)
+        vault.flush()
+    elif action == "migrate":
+        migrate_secrets(secrets, envs, vault)
+    else:
+        decrypt_secrets(secrets, envs, vault)
+
+def list_tree(vault, mount_point, prefix, depth, parallel):
+    # Lists a Vault folder and its sub-folders level by level, the folders of a level concurrently
+    # Returns the keys of every folder listed, None for a folder that doesn't exist
+    import concurrent.futures
+    listings = {}
+    level = [prefix]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=parallel) as executor:
+        for _ in range(depth):
+            if not level:
+                break
+            results = list(executor.map(lambda folder: vault.list_secrets(mount_point, folder), level))
+            listings.update(zip(level, results))
+            level = [f"{folder}/{key.rstrip('/')}" for folder, keys in zip(level, results) for key in keys or [] if key.endswith("/")]
+    return listings
+
+def listed_as_missing(listings, prefix, path):
+    # True when the listings show the secret at path doesn't exist, False when it exists or is deeper than what was listed
+    folder = prefix
+    parts = path[len(prefix) + 1:].split("/")
+    for position, part in enumerate(parts):
+        if folder not in listings:
+            return False
+        keys = listings[folder]
+        if keys is None:
+            return True
+        if position == len(parts) - 1:
+            return part not in keys
+        if f"{part}/" not in keys:
+            return True
+        folder = f"{folder}/{part}"
+    return False
+
+def prefetch_secrets(jobs, envs, vault):
+    # jobs are the (environment, (container, key, path, full_path)) of every placeholder of the run
+    # Lists the chart's folder in Vault for each environment, then reads every secret the placeholders use concurrently,
+    # so the substitution that follows is served from the run's cache and skips the secrets the listing shows missing
+    # Secrets no placeholder uses, and placeholders whose secret is missing, are reported on stderr
+    import concurrent.futures
+    referenced = {}
+    for environment, (data, key, path, full_path) in jobs:
+        mount_point, _path, field = vault.locate(full_path, path, key, environment=environment)
+        referenced.setdefault((mount_point, _path), set()).add(field)
+
+    # Secrets of placeholders without a template path sit under the chart's folder of their environment, or are that folder when packed
+    environments = sorted({environment for environment, (data, key, path, full_path) in jobs if full_path is None})
+    prefixes = [(envs.vault_mount_point, f"{envs.vault_path}/{vault.folder}{f'/{environment}' if environment else ''}") for environment in environments]
+
+    orphans, listed = [], 0
+    if envs.layout != "packed":
+        for mount_point, prefix in prefixes:
+            listings = list_tree(vault, mount_point, prefix, envs.prefetch_depth, envs.parallel)
+            listed += len(listings)
+            leaves = {f"{folder}/{key}" for folder, keys in listings.items() for key in keys or [] if not key.endswith("/")}
+            orphans += [leaf for leaf in sorted(leaves) if (mount_point, leaf) not in referenced]
+            for (secret_mount_point, path) in referenced:
+                if (secret_mount_point == mount_point) and path.startswith(f"{prefix}/") and listed_as_missing(listings, prefix, path):
+                    vault.remember_missing(mount_point, path)
+
+    def read(secret):
+        try:
+            return vault.read_secret(*secret)
+        except Exception:
+            return None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=envs.parallel) as executor:
+        secrets = dict(zip(referenced, executor.map(read, referenced)))
+
+    missing = []
+    for (mount_point, path), fields in sorted(referenced.items()):
+        secret = secrets[(mount_point, path)]
+        if secret is None:
+            missing.append(path)
+            continue
+        missing += [f"{path} ({field})" for field in sorted(fields) if field not in secret]
+        if (envs.layout == "packed") and ((mount_point, path) in prefixes):
+            orphans += [f"{path} ({field})" for field in sorted(secret) if field not in fields]
+
+    read_count = len([secret for secret in secrets.values() if secret is not None])
+    lines = [f"Prefetch: listed {listed} folders, read {read_count} secrets, {len(orphans)} unused, {len(missing)} missing"]
+    lines += [f"Unused secret: {orphan}" for orphan in orphans]
+    lines += [f"Missing secret: {path}" for path in missing]
+    sys.stderr.write("\n".join(lines) + "\n")
+    return orphans, missing
+
+def decrypted_values(secrets, locations, vault):
+    # The Vault location, place in the decrypted file and value of every secret read, for edit to tell which ones change
+    # locations are the keys and list positions leading to each placeholder, from the placeholder index
+    # Secrets that could not be read hold their placeholder, and are never written back
+    originals = []
+    for (data, key, path, full_path), location in zip(secrets, locations):
+        mount_point, _path, field = vault.locate(full_path, path, key)
+        if _path not in vault.failed:
+            originals.append(((mount_point, _path, field), location, data[key]))
+    return originals
+
+def value_at(data, location):
+    # The value at the end of a list of keys and list positions, raising LookupError when it isn't there
+    for step in location:
+        if not isinstance(data, (dict, list)):
+            raise LookupError(step)
+        data = data[step]
+    return data
+
+def write_back_edits(decode_file, originals, envs, vault):
+    # Write the secrets whose value changed in the edited file back to Vault, concurrently and with KV v2 check-and-set,
+    # then remove the file. A secret changed in Vault since it was decrypted is not overwritten, and the file is kept
+    # whenever a change could not be written, so no edit is lost
+    import concurrent.futures
+    try:
+        edited = load_yaml(decode_file)
+    except Exception as ex:
+        raise Exception(f"Could not read {decode_file} back, nothing was written to Vault: {ex}")
+
+    changes, removed = [], 0
+    for (mount_point, path, field), location, value in originals:
+        place = "/".join(str(step) for step in location)
+        try:
+            new_value = value_at(edited, location)
+        except (LookupError, TypeError):
+            print(f"Error: {place} is no longer in {decode_file}, its secret was left alone")
+            removed += 1
+            continue
+        if new_value != value:
+            changes.append(((mount_point, path, field), place, value, str(new_value) if isinstance(new_value, str) else new_value))
+
+    # Compare with what Vault holds now rather than with the cached reads of the run, so check-and-set is against the current version
+    vault.disk_cache_reads = False
+    vault.agent_reads = False
+    secrets = sorted({(mount_point, path) for (mount_point, path, field), place, value, new_value in changes})
+    for mount_point, path in secrets:
+        vault.forget_secret(mount_point, path)
+
+    def read(secret):
+        try:
+            return vault.read_secret(*secret)
+        except SecretNotFound:
+            return {}
+
+    with vault.metrics.phase("vault"):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=envs.parallel) as executor:
+            current = dict(zip(secrets, executor.map(read, secrets)))
+        conflicts = 0
+        for (mount_point, path, field), place, value, new_value in changes:
+            if current[(mount_point, path)].get(field) != value:
+                print(f"Error: {place} was changed in Vault while it was being edited, not overwriting it")
+                conflicts += 1
+            else:
+                vault.stage(mount_point, path, field, new_value)
+        results = vault.flush() if vault.pending else []
+
+    failed = conflicts + results.count("failed")
+    if failed or removed:
+        raise Exception(f"{failed + removed} changed or removed secret(s) were not written to Vault, {decode_file} was kept")
+    print(f"Wrote {len(changes)} changed secret(s) to Vault")
+    for filename in [decode_file, f"{decode_file}.manifest"]:
+        if os.path.exists(filename):
+            os.remove(filename)
+    if envs.args.verbose is True:
+        print(f"Deleted {decode_file}")
+
+def stream_values(yaml_file, action, envs, secret_data, vault):
+    # Yields the documents of a values file one at a time, each processed before the next one is read
+    # Only the current document is held in memory, comments and quotes are kept as with load_yaml
+    import ruamel.yaml
+    yaml = ruamel.yaml.YAML()
+    yaml.preserve_quotes = True
+    with open(yaml_file) as source:
+        for data in yaml.load_all(source):
+            with vault.metrics.phase("index"):
+                secrets = list(dict_walker(envs.secret_delim, data, envs))
+            with vault.metrics.phase("vault"):
+                process_secrets(action, secrets, envs, secret_data, vault)
+            yield data
+
+def dump_values(yaml, data, output):
+    # A streamed values file is a generator of documents, each written out as soon as it is substituted
+    # The text engine has already produced the file's text
+    if isinstance(data, str):
+        output.write(data)
+    elif hasattr(data, "__next__"):
+        yaml.dump_all(data, output)
+    else:
+        yaml.dump(data, output)
+
+def file_digest(filename):
+    with open(filename, "rb") as digest_file:
+        return hashlib.sha256(digest_file.read()).hexdigest()
+
+def decrypt_options(envs):
+    # Settings that change what a decrypted file contains
+    return dict(
+        vault_addr=envs.vault_addr,
+        mount_point=envs.vault_mount_point,
+        vault_path=envs.vault_path,
+        deliminator=envs.secret_delim,
+        template=envs.secret_template,
+        kvversion=envs.kvversion,
+        layout=envs.layout,
+        environment=envs.environment,
+        engine=envs.engine,
+        stream=getattr(envs.args, "stream", False),
+        cwd=os.getcwd(),
+    )
+
+def write_manifest(yaml_file, decode_file, envs, vault):
+    # Record what a decrypted file was built from, next to it, so an unchanged rerun can skip Vault
+    manifest = dict(
+        source=file_digest(yaml_file),
+        output=file_digest(decode_file),
+        options=decrypt_options(envs),
+        checked=time.time(),
+        secrets=[[mount_point, path, version] for (mount_point, path), version in sorted(vault.versions.items())],
+    )
+    with open(f"{decode_file}.manifest", "w") as manifest_file:
+        json.dump(manifest, manifest_file)
+
+def decrypted_file_is_current(yaml_file, decode_file, envs, vault):
+    # The decrypted file is current when neither the source, the options, the output nor any referenced secret changed
+    # Within the cache TTL the secrets are not checked, otherwise one KV v2 metadata read per secret is made
+    import concurrent.futures
+    try:
+        with open(f"{decode_file}.manifest") as manifest_file:
+            manifest = json.load(manifest_file)
+        if (manifest["source"] != file_digest(yaml_file)) or (manifest["output"] != file_digest(decode_file)):
+            return False
+    except (OSError, ValueError, KeyError):
+        return False
+    if manifest.get("options") != decrypt_options(envs):
+        return False
+
+    if time.time() - manifest.get("checked", 0) < envs.cache_ttl:
+        return True
+    if envs.kvversion != "v2":
+        return False
+
+    secrets = manifest.get("secrets", [])
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=envs.parallel) as executor:
+            versions = list(executor.map(lambda secret: vault.fetch_version(secret[0], secret[1]), secrets))
+    except Exception as ex:
+        if envs.args.verbose is True:
+            print(f"Could not check secret versions: {ex}")
+        return False
+    if versions != [secret[2] for secret in secrets]:
+        return False
+
+    manifest["checked"] = time.time()
+    with open(f"{decode_file}.manifest", "w") as manifest_file:
+        json.dump(manifest, manifest_file)
+    return True
+
+def write_fd(fd, content):
+    # Feed a pipe until helm has read it all, or has gone away
+    try:
+        with os.fdopen(fd, "wb") as pipe:
+            pipe.write(content)
+    except BrokenPipeError:
+        pass
+
+def serve_values(yaml, documents):
+    # Hand the decrypted documents to helm as /dev/fd/N paths, so no plaintext is written to disk
+    # Linux uses a memfd per document, other platforms a pipe fed by a writer thread
+    paths, fds = [], []
+    for data in documents:
+        if hasattr(os, "memfd_create"):
+            fd = os.memfd_create("helm-vault-values")
+            with os.fdopen(os.dup(fd), "w", newline="") as memfd:
+                dump_values(yaml, data, memfd)
+        else:
+            stream = io.StringIO()
+            dump_values(yaml, data, stream)
+            fd, pipe = os.pipe()
+            threading.Thread(target=write_fd, args=(pipe, stream.getvalue().encode()), daemon=True).start()
+        paths.append(f"/dev/fd/{fd}")
+        fds.append(fd)
+    return paths, fds
 
 def load_secret(args):
     if args.secret_file:
@@ -354,58 +2552,389 @@ def load_secret(args):
             raise Exception(f"ERROR: Secret file name must end with \".yaml.dec\". {args.secret_file} was given instead.")
         return load_yaml(args.secret_file)
 
+class Release:
+    """One release of a batch manifest, with the state of its run.
+
+    Manifest entries take a name, chart, action (install, template, upgrade, lint or diff,
+    default upgrade), values (one file or a list), environment and args (extra helm arguments).
+    """
+
+    ACTIONS = ("install", "template", "upgrade", "lint", "diff")
+
+    def __init__(self, entry, position, envs):
+        if not isinstance(entry, dict):
+            raise Exception(f"Release {position} of the batch manifest must be a mapping")
+        self.name = str(entry.get("name") or f"release-{position}")
+        self.chart = entry.get("chart")
+        self.action = entry.get("action", "upgrade")
+        if self.action not in self.ACTIONS:
+            raise Exception(f"Release {self.name}: action must be one of {', '.join(self.ACTIONS)}, not {self.action}")
+        if not self.chart and self.action != "diff":
+            raise Exception(f"Release {self.name} has no chart")
+        values = entry.get("values") or []
+        self.values = [str(values)] if isinstance(values, str) else [str(value) for value in values]
+        args = entry.get("args") or []
+        if isinstance(args, str):
+            import shlex
+            args = shlex.split(args)
+        self.args = [str(arg) for arg in args]
+
+        # Each release may set its own environment, which the placeholder paths and decrypted file names depend on
+        self.envs = copy.copy(envs)
+        self.envs.environment = str(entry.get("environment") or envs.environment or "")
+
+        self.splices = None
+        self.documents = []
+        self.secrets = []
+        self.failed = []
+        self.result = "pending"
+        self.returncode = None
+        self.seconds = 0.0
+        self.output = ""
+
+    def command(self, values):
+        # helm <action> <args> <name> <chart> -f ..., lint taking no release name
+        cmd = ["helm", self.action] + self.args
+        if self.action != "lint":
+            cmd.append(self.name)
+        if self.chart:
+            cmd.append(str(self.chart))
+        for value_file in values:
+            cmd += ["-f", value_file]
+        return cmd
+
+    def decode_files(self):
+        return ['.'.join(filter(None, [yaml_file, self.name, self.envs.environment, 'dec'])) for yaml_file in self.values]
+
+def load_releases(manifest_file, envs):
+    manifest = load_yaml(manifest_file)
+    entries = manifest.get("releases") if isinstance(manifest, dict) else manifest
+    if not isinstance(entries, list) or not entries:
+        raise Exception(f"{manifest_file} must hold a list of releases, under a releases key or at the top level")
+    return [Release(entry, position, envs) for position, entry in enumerate(entries, 1)]
+
+def run_release(release, yaml, args, envs):
+    # Hand one release's decrypted values to helm, capturing its output so concurrent releases don't interleave
+    import subprocess
+    if release.failed:
+        release.result = f"{len(release.failed)} secret(s) missing"
+        return
+    if envs.delivery == "memory":
+        values, fds = serve_values(yaml, release.documents)
+    else:
+        values, fds = release.decode_files(), []
+        for data, decode_file in zip(release.documents, values):
+            with open(decode_file, "w", newline="") as output:
+                dump_values(yaml, data, output)
+
+    cmd = release.command(values)
+    if args.verbose is True:
+        print(f"About to execute command: {' '.join(cmd)}")
+    start = time.perf_counter()
+    try:
+        completed = subprocess.run(cmd, pass_fds=fds, capture_output=True, text=True)
+        release.returncode = completed.returncode
+        release.output = completed.stdout + completed.stderr
+        release.result = "ok" if completed.returncode == 0 else f"helm exited with {completed.returncode}"
+    except Exception as ex:
+        release.result = f"Error: {ex}"
+    finally:
+        release.seconds = time.perf_counter() - start
+        for fd in fds:
+            os.close(fd)
+        if envs.delivery == "file":
+            for decode_file in values:
+                if os.path.exists(decode_file):
+                    os.remove(decode_file)
+
+def run_batch(args, envs, metrics):
+    # Decrypt the values of every release of a manifest with one Vault session, cache and pool, then run helm for them
+    import concurrent.futures
+    import ruamel.yaml
+    with metrics.phase("yaml_load"):
+        releases = load_releases(args.manifest, envs)
+        yaml = ruamel.yaml.YAML()
+        yaml.preserve_quotes = True
+
+    with metrics.phase("vault_setup"):
+        vault = Vault(args, envs, metrics)
+    if envs.snapshot:
+        vault.load_snapshot(envs.snapshot)
+
+    with metrics.phase("index"):
+        for release in releases:
+            release.splices = text_substitution(release.values, release.action, release.envs)
+            if release.splices is not None:
+                release.secrets = [list(splice_placeholders(index, release.envs)) for text, index in release.splices]
+            else:
+                release.documents = [load_yaml(yaml_file) for yaml_file in release.values]
+                release.secrets = [list(resolve_placeholders(placeholder_index(yaml_file, data, release.envs), data, release.envs)) for yaml_file, data in zip(release.values, release.documents)]
+
+    # Every secret of every release goes through the same pool, a secret shared by several releases is read once
+    jobs = [(release, secret) for release in releases for secrets in release.secrets for secret in secrets]
+
+    if args.prefetch:
+        with metrics.phase("prefetch"):
+            prefetch_secrets([(release.envs.environment, secret) for release, secret in jobs], envs, vault)
+
+    def read(job):
+        release, (data, key, path, full_path) = job
+        return vault.vault_read(data[key], path, key, full_path, environment=release.envs.environment, failed=release.failed)
+
+    with metrics.phase("vault"):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=envs.parallel) as executor:
+            values = list(executor.map(read, jobs))
+        for (release, (data, key, path, full_path)), value in zip(jobs, values):
+            data[key] = value
+    with metrics.phase("yaml_dump"):
+        for release in releases:
+            if release.splices is not None:
+                release.documents = [splice_values(text, index, secrets) for (text, index), secrets in zip(release.splices, release.secrets)]
+
+    with metrics.phase("helm"):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(envs.jobs, 1)) as executor:
+            list(executor.map(lambda release: run_release(release, yaml, args, envs), releases))
+
+    finish_run(args, envs, metrics, vault)
+
+    # Per release report, in manifest order
+    width = max(len("Release"), *(len(release.name) for release in releases))
+    print(f"{'Release':<{width}}  {'Seconds':>8}  Result")
+    for release in releases:
+        print(f"{release.name:<{width}}  {release.seconds:>8.2f}  {release.result}")
+    for release in releases:
+        if release.output and ((release.result != "ok") or (args.verbose is True)):
+            print(f"--- {release.name} ---\n{release.output.rstrip()}")
+    if args.report_file:
+        with open(args.report_file, "w") as report_file:
+            json.dump([dict(name=release.name, action=release.action, chart=release.chart, environment=release.envs.environment,
+                            result=release.result, returncode=release.returncode, seconds=round(release.seconds, 3),
+                            secrets=sum(len(secrets) for secrets in release.secrets), missing=len(release.failed)) for release in releases], report_file, indent=2)
+
+    failed = [release.name for release in releases if release.result != "ok"]
+    if failed:
+        raise Exception(f"{len(failed)} of {len(releases)} releases failed: {', '.join(failed)}")
+
+def run_snapshot(args, envs, metrics):
+    # Read every secret the placeholders of the values files use in each environment, then bundle them
+    # A missing secret fails the run rather than producing a bundle pipelines would fail on later
+    import concurrent.futures
+    with metrics.phase("vault_setup"):
+        vault = Vault(args, envs, metrics)
+
+    jobs = []
+    with metrics.phase("index"):
+        for environment in args.environments or [envs.environment]:
+            environment_envs = copy.copy(envs)
+            environment_envs.environment = environment
+            for yaml_file in args.yaml_file:
+                splices = text_substitution([yaml_file], args.action, environment_envs)
+                if splices is not None:
+                    secrets = splice_placeholders(splices[0][1], environment_envs)
+                else:
+                    data = load_yaml(yaml_file)
+                    secrets = resolve_placeholders(placeholder_index(yaml_file, data, environment_envs), data, environment_envs)
+                jobs += [(environment, secret) for secret in secrets]
+
+    def read(job):
+        environment, (data, key, path, full_path) = job
+        vault.vault_read(data[key], path, key, full_path, environment=environment)
+
+    with metrics.phase("vault"):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=envs.parallel) as executor:
+            list(executor.map(read, jobs))
+    if vault.failed:
+        finish_run(args, envs, metrics, vault)
+        raise Exception(f"{len(vault.failed)} secret(s) could not be read from Vault, no snapshot was written")
+
+    with metrics.phase("snapshot"):
+        snapshot = Snapshot.from_vault(vault)
+        snapshot.save(args.bundle, envs, vault)
+    finish_run(args, envs, metrics, vault)
+    print(f"Wrote {len(snapshot.secrets)} secrets to {args.bundle}")
+
 def main(argv=None):
 
     # Parse arguments from argparse
     # This is outside of the parse_arg function because of issues returning multiple named values from a function
+    metrics = Metrics()
     parsed = parse_args(argv)
     args, leftovers = parsed.parse_known_args(argv)
+    metrics.action = args.action
+
+    # snapshot bundles the secrets of many values files and environments
+    if args.action == "snapshot":
+        return run_snapshot(args, Envs(args), metrics)
+
+    # agent serves the other commands until it is stopped
+    if args.action == "agent":
+        return run_agent(args, Envs(args), metrics)
 
-    yaml_file = args.yaml_file
-    data = load_yaml(yaml_file)
+    # batch runs many releases, each with its own values files
+    if args.action == "batch":
+        return run_batch(args, Envs(args), metrics)
+
+    # The helm wrappers take any number of -f files, the other actions a single one
+    yaml_files = args.yaml_file if isinstance(args.yaml_file, list) else [args.yaml_file]
     action = args.action
 
     envs = Envs(args)
 
+    # clean only needs the file to exist, without loading YAML or touching Vault
     if action == "clean":
+        if args.yaml_file is not None:
+            os.stat(args.yaml_file)
         cleanup(args, envs)
 
-    yaml = ruamel.yaml.YAML()
-    yaml.preserve_quotes = True
-    secret_data = load_secret(args) if args.action == 'enc' else None
+    # --stream reads each values file a document at a time while writing it out, instead of loading it here
+    # The text engine splices secrets into the text of the values files, which then aren't loaded as YAML at all
+    streaming = getattr(args, "stream", False)
+    with metrics.phase("index"):
+        splices = None if streaming else text_substitution(yaml_files, action, envs)
+    with metrics.phase("yaml_load"):
+        documents = [] if streaming or (splices is not None) else [load_yaml(yaml_file) for yaml_file in yaml_files]
+        yaml = None
+        if splices is None:
+            import ruamel.yaml
+            yaml = ruamel.yaml.YAML()
+            yaml.preserve_quotes = True
+        secret_data = load_secret(args) if args.action == 'enc' else None
 
-    for path, key, value in dict_walker(envs.secret_delim, data, args, envs, secret_data):
-        print("Done")
-    
-    decode_file = '.'.join(filter(None, [yaml_file, envs.environment, 'dec']))
+    # One Vault session per invocation, shared by every secret of every file
+    with metrics.phase("vault_setup"):
+        vault = Vault(args, envs, metrics)
+    if envs.snapshot:
+        vault.load_snapshot(envs.snapshot)
 
+    # dec leaves an existing decrypted file alone when nothing it was built from has changed
+    # edit always decrypts, as it needs the values it shows to tell which ones were changed
+    decode_files = ['.'.join(filter(None, [yaml_file, envs.environment, 'dec'])) for yaml_file in yaml_files]
     if action == "dec":
-        yaml.dump(data, open(decode_file, "w"))
+        with metrics.phase("manifest"):
+            current = not args.refresh and decrypted_file_is_current(yaml_files[0], decode_files[0], envs, vault)
+        if current:
+            if args.verbose is True:
+                print(f"{decode_files[0]} is up to date")
+            finish_run(args, envs, metrics, vault)
+            print("Done Decrypting")
+            return
+
+    secrets, locations = None, None
+    if streaming:
+        documents = [stream_values(yaml_file, action, envs, secret_data, vault) for yaml_file in yaml_files]
+        if (action == "enc") or (action == "migrate"):
+            for stream in documents:
+                for data in stream:
+                    pass
+    elif splices is not None:
+        file_secrets = [list(splice_placeholders(index, envs)) for text, index in splices]
+        secrets = [secret for placeholders in file_secrets for secret in placeholders]
+        locations = [location + [key] for text, index in splices for location, key, *_ in index]
+        if getattr(args, "prefetch", False):
+            with metrics.phase("prefetch"):
+                prefetch_secrets([(envs.environment, secret) for secret in secrets], envs, vault)
+        with metrics.phase("vault"):
+            process_secrets(action, secrets, envs, secret_data, vault)
+        with metrics.phase("yaml_dump"):
+            documents = [splice_values(text, index, secrets) for (text, index), secrets in zip(splices, file_secrets)]
+    else:
+        with metrics.phase("index"):
+            indexes = [placeholder_index(yaml_file, data, envs) for yaml_file, data in zip(yaml_files, documents)]
+            secrets = [secret for index, data in zip(indexes, documents) for secret in resolve_placeholders(index, data, envs)]
+            locations = [location + [key] for index in indexes for location, key, *_ in index]
+        if getattr(args, "prefetch", False) and (action != "enc") and (action != "migrate"):
+            with metrics.phase("prefetch"):
+                prefetch_secrets([(envs.environment, secret) for secret in secrets], envs, vault)
+        with metrics.phase("vault"):
+            process_secrets(action, secrets, envs, secret_data, vault)
+    if (action == "enc") or (action == "migrate"):
+        finish_run(args, envs, metrics, vault)
+    if action == "migrate":
+        print("Done Migrating")
+
+    data = documents[0] if documents else None
+    decode_file = decode_files[0] if decode_files else None
+
+    if action == "dec":
+        with metrics.phase("yaml_dump"):
+            with open(decode_file, "w", newline="") as output:
+                dump_values(yaml, data, output)
+            if not vault.failed:
+                write_manifest(yaml_file=yaml_files[0], decode_file=decode_file, envs=envs, vault=vault)
+        finish_run(args, envs, metrics, vault)
         print("Done Decrypting")
     elif action == "view":
-        yaml.dump(data, sys.stdout)
+        with metrics.phase("yaml_dump"):
+            dump_values(yaml, data, sys.stdout)
+        finish_run(args, envs, metrics, vault)
     elif action == "edit":
-        yaml.dump(data, open(decode_file, "w"))
+        with metrics.phase("yaml_dump"):
+            with open(decode_file, "w", newline="") as output:
+                dump_values(yaml, data, output)
+        # Streamed documents aren't kept, and a snapshot can't be written to, so those edits stay in the file
+        originals = None if (secrets is None) or envs.snapshot else decrypted_values(secrets, locations, vault)
         os.system(envs.editor + ' ' + f"{decode_file}")
+        if originals is None:
+            print(f"Changes to {decode_file} are not written back with --stream or --snapshot, use enc to store them")
+        else:
+            write_back_edits(decode_file, originals, envs, vault)
+        finish_run(args, envs, metrics, vault)
     # These Helm commands are only different due to passed variables
     elif (action == "install") or (action == "template") or (action == "upgrade") or (action == "lint") or (action == "diff"):
-        yaml.dump(data, open(decode_file, "w"))
-        leftovers = ' '.join(leftovers)
+        # Never hand helm placeholders in place of secrets Vault didn't return
+        if vault.failed:
+            finish_run(args, envs, metrics, vault)
+            raise Exception(f"{len(vault.failed)} secret(s) could not be read from Vault, helm was not run")
+        with metrics.phase("yaml_dump"):
+            if envs.delivery == "memory":
+                values, fds = serve_values(yaml, documents)
+            else:
+                for data, decode_file in zip(documents, decode_files):
+                    with open(decode_file, "w", newline="") as output:
+                        dump_values(yaml, data, output)
+                values, fds = decode_files, []
+
+        # Streamed documents are only read from Vault while they are written out, so check again before running helm
+        if vault.failed:
+            for fd in fds:
+                os.close(fd)
+            if envs.delivery == "file":
+                for decode_file in decode_files:
+                    if os.path.exists(decode_file):
+                        os.remove(decode_file)
+            finish_run(args, envs, metrics, vault)
+            raise Exception(f"{len(vault.failed)} secret(s) could not be read from Vault, helm was not run")
 
+        # helm's exit status becomes the exit status of the run, so pipelines see a failed deploy
+        returncode = 1
         try:
-            cmd = f"helm {args.action} {leftovers} -f {decode_file}"
+            cmd = ["helm", args.action] + leftovers
+            for value_file in values:
+                cmd += ["-f", value_file]
             if args.verbose is True:
-                print(f"About to execute command: {cmd}")
-            subprocess.run(cmd, shell=True)
+                print(f"About to execute command: {' '.join(cmd)}")
+            import subprocess
+            with metrics.phase("helm"):
+                returncode = subprocess.run(cmd, pass_fds=fds).returncode
         except Exception as ex:
             print(f"Error: {ex}")
+        finally:
+            for fd in fds:
+                os.close(fd)
 
-        cleanup(args, envs)
+        finish_run(args, envs, metrics, vault)
+        if envs.delivery == "file":
+            cleanup(args, envs)
+        return returncode
 
 if __name__ == "__main__":
+    # Exit non-zero when the run failed, or with helm's own status, so CI doesn't report a failed run as green
+    status = 0
     try:
-        main()
+        status = main() or 0
     except Exception as ex:
         print(f"ERROR: {ex}")
+        status = 1
     except SystemExit:
         pass
+    sys.exit(status)
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+
+import os
+import stat
+
+import pytest
+
+import src.vault as vault
+from tests.fake_vault import FakeVault
+
+
+@pytest.fixture
+def fake_vault(tmp_path, monkeypatch):
+    # An in-process Vault the run talks to, KV v2 by default, with a cache directory of its own and print silenced
+    # Test files needing more override it, taking this one as their argument
+    with FakeVault() as server:
+        monkeypatch.setenv("VAULT_ADDR", server.addr)
+        monkeypatch.setenv("VAULT_TOKEN", server.token)
+        monkeypatch.setenv("KVVERSION", "v2")
+        monkeypatch.setenv("VAULT_CACHE_DIR", str(tmp_path / "cache"))
+        monkeypatch.setattr(vault, "print", lambda s : None, raising=False)
+        yield server
+
+
+@pytest.fixture
+def stub_helm(tmp_path, monkeypatch):
+    # Puts a helm running the given shell script first on PATH, returning its path
+    def stub(script):
+        helm = tmp_path / "bin" / "helm"
+        helm.parent.mkdir(exist_ok=True)
+        helm.write_text(f"#!/bin/sh\n{script}")
+        helm.chmod(helm.stat().st_mode | stat.S_IEXEC)
+        monkeypatch.setenv("PATH", f"{helm.parent}{os.pathsep}{os.environ['PATH']}")
+        return helm
+    return stub
+
+
+@pytest.fixture
+def values_file(tmp_path):
+    values_file = tmp_path / "values.yaml"
+    values_file.write_text("database:\n  user: VAULT:/secret/app/user\n  password: VAULT:/secret/app/password\n")
+    return str(values_file)
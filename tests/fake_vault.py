@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+class FakeVault:
+    """In-process KV v1/v2 server speaking enough of the Vault HTTP API for the plugin.
+
+    latency is added to every request (seconds), error_rate is the fraction of
+    requests answered with error_status instead of being served, and failures the
+    number of upcoming requests answered with error_status. token_info is what
+    auth/token/lookup-self returns, auth/token/renew-self resets its ttl to creation_ttl.
+    auth/approle/login and auth/kubernetes/login hand out the token for role_id/secret_id
+    and role/jwt, counting logins.
+    """
+
+    def __init__(self, token="fake-token", kv2_mounts=("secret",), latency=0.0, error_rate=0.0,
+                 error_status=503, retry_after=None, standby=False, failures=0):
+        self.token = token
+        self.kv2_mounts = set(kv2_mounts)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.standby = standby
+        self.failures = failures
+        self.token_info = dict(ttl=0, creation_ttl=0, renewable=False)
+        self.renewals = 0
+        self.approle = dict(role_id="fake-role-id", secret_id="fake-secret-id")
+        self.kubernetes = dict(role="fake-role", jwt="fake-jwt")
+        self.logins = 0
+        self.kv1 = {}
+        self.kv2 = {}
+        self.requests = []
+        self.connections = set()
+        self.lock = threading.RLock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def addr(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def put_v2(self, mount, path, data):
+        with self.lock:
+            versions = self.kv2.setdefault((mount, path.strip("/")), [])
+            versions.append(dict(data))
+            return len(versions)
+
+    def get_v2(self, mount, path):
+        versions = self.kv2.get((mount, path.strip("/")))
+        return versions[-1] if versions else None
+
+    def count(self, method=None):
+        return len([r for r in self.requests if method is None or r[0] == method])
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, body=None, headers=None):
+                payload = json.dumps(body).encode() if body is not None else b""
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _body(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                return json.loads(self.rfile.read(length) or b"{}") if length else {}
+
+            def _handle(self, method):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                if method == "GET" and query.get("list") == ["true"]:
+                    method = "LIST"
+                body = self._body() if method in ("POST", "PUT") else {}
+                with fake.lock:
+                    fake.requests.append((method, url.path))
+                    fake.connections.add(self.client_address)
+                    failing = fake.failures > 0
+                    fake.failures -= failing
+                if fake.latency:
+                    time.sleep(fake.latency)
+                if failing or (fake.error_rate and random.random() < fake.error_rate):
+                    headers = {"Retry-After": str(fake.retry_after)} if fake.retry_after is not None else None
+                    return self._reply(fake.error_status, {"errors": ["injected failure"]}, headers)
+
+                parts = [p for p in url.path.split("/") if p][1:]
+                if parts[:2] == ["sys", "health"]:
+                    return self._reply(473 if fake.standby else 200, {"initialized": True, "sealed": False,
+                                                                       "standby": fake.standby,
+                                                                       "performance_standby": fake.standby})
+                if (parts[:1] == ["auth"]) and (parts[2:] == ["login"]) and (parts[1] in ("approle", "kubernetes")):
+                    if body != getattr(fake, parts[1]):
+                        return self._reply(400, {"errors": ["invalid credentials"]})
+                    with fake.lock:
+                        fake.logins += 1
+                    return self._reply(200, {"auth": {"client_token": fake.token, "lease_duration": fake.token_info["creation_ttl"],
+                                                      "renewable": fake.token_info["renewable"]}})
+                if self.headers.get("X-Vault-Token") != fake.token:
+                    return self._reply(403, {"errors": ["permission denied"]})
+                if not parts:
+                    return self._reply(404, {"errors": []})
+                if parts == ["auth", "token", "lookup-self"]:
+                    return self._reply(200, {"data": dict(fake.token_info)})
+                if parts == ["auth", "token", "renew-self"]:
+                    with fake.lock:
+                        fake.renewals += 1
+                        fake.token_info["ttl"] = fake.token_info["creation_ttl"]
+                    return self._reply(200, {"auth": {"client_token": fake.token, "lease_duration": fake.token_info["ttl"],
+                                                      "renewable": fake.token_info["renewable"]}})
+
+                if (parts[:1] == ["transit"]) and (len(parts) == 3) and (method in ("POST", "PUT")):
+                    # Not encryption, only enough to tell a transit ciphertext from its plaintext
+                    if parts[1] == "encrypt":
+                        return self._reply(200, {"data": {"ciphertext": "vault:v1:" + body["plaintext"][::-1]}})
+                    if parts[1] == "decrypt":
+                        return self._reply(200, {"data": {"plaintext": body["ciphertext"][len("vault:v1:"):][::-1]}})
+                mount, rest = parts[0], parts[1:]
+                if mount in fake.kv2_mounts and rest and rest[0] in ("data", "metadata"):
+                    return self._kv2(method, mount, rest[0], "/".join(rest[1:]), body, query)
+                return self._kv1(method, "/".join(parts), body)
+
+            def _kv1(self, method, path, body):
+                if method == "GET":
+                    if path not in fake.kv1:
+                        return self._reply(404, {"errors": []})
+                    return self._reply(200, {"data": fake.kv1[path]})
+                if method in ("POST", "PUT"):
+                    fake.kv1[path] = body
+                    return self._reply(204)
+                if method == "LIST":
+                    prefix = path.rstrip("/") + "/"
+                    keys = sorted({k[len(prefix):].split("/")[0] + ("/" if "/" in k[len(prefix):] else "")
+                                   for k in fake.kv1 if k.startswith(prefix)})
+                    if not keys:
+                        return self._reply(404, {"errors": []})
+                    return self._reply(200, {"data": {"keys": keys}})
+                return self._reply(405, {"errors": ["unsupported"]})
+
+            def _kv2(self, method, mount, kind, path, body, query):
+                versions = fake.kv2.get((mount, path))
+                if kind == "data" and method == "GET":
+                    if not versions:
+                        return self._reply(404, {"errors": []})
+                    return self._reply(200, {"data": {"data": versions[-1],
+                                                      "metadata": {"version": len(versions)}}})
+                if kind == "data" and method in ("POST", "PUT"):
+                    cas = (body.get("options") or {}).get("cas")
+                    with fake.lock:
+                        current = len(fake.kv2.get((mount, path), []))
+                        if cas is not None and cas != current:
+                            return self._reply(400, {"errors": ["check-and-set parameter did not match the current version"]})
+                        version = fake.put_v2(mount, path, body.get("data", {}))
+                    return self._reply(200, {"data": {"version": version}})
+                if kind == "metadata" and method == "GET":
+                    if not versions:
+                        return self._reply(404, {"errors": []})
+                    return self._reply(200, {"data": {"current_version": len(versions),
+                                                      "versions": {str(i + 1): {} for i in range(len(versions))}}})
+                if kind == "metadata" and method == "LIST":
+                    prefix = path.rstrip("/") + "/" if path else ""
+                    keys = sorted({k[len(prefix):].split("/")[0] + ("/" if "/" in k[len(prefix):] else "")
+                                   for (m, k) in fake.kv2 if m == mount and k.startswith(prefix)})
+                    if not keys:
+                        return self._reply(404, {"errors": []})
+                    return self._reply(200, {"data": {"keys": keys}})
+                return self._reply(405, {"errors": ["unsupported"]})
+
+            def do_GET(self):
+                self._handle("GET")
+
+            def do_POST(self):
+                self._handle("POST")
+
+            def do_PUT(self):
+                self._handle("PUT")
+
+            def do_LIST(self):
+                self._handle("LIST")
+
+        return Handler
+
+
+if __name__ == "__main__":
+    # Serve on a fixed port for manual runs, e.g. VAULT_ADDR=http://127.0.0.1:8200 VAULT_TOKEN=fake-token
+    import sys
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8200
+    fake = FakeVault()
+    fake.server.server_close()
+    fake.server = ThreadingHTTPServer(("127.0.0.1", port), fake._handler())
+    fake.server.daemon_threads = True
+    print(f"Fake Vault listening on {fake.addr} with token {fake.token}")
+    fake.server.serve_forever()
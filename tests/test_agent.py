@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+import socket
+import threading
+import time
+
+import pytest
+
+import src.vault as vault
+
+
+@pytest.fixture
+def fake_vault(fake_vault, tmp_path, monkeypatch):
+    monkeypatch.setenv("VAULT_AGENT_SOCKET", str(tmp_path / "agent.sock"))
+    fake_vault.put_v2("secret", "app/user", {"value": "admin"})
+    fake_vault.put_v2("secret", "app/password", {"value": "hunter2"})
+    return fake_vault
+
+
+@pytest.fixture
+def agent(fake_vault):
+    args, _ = vault.parse_args(['agent']).parse_known_args(['agent'])
+    agent = vault.Agent(args, vault.Envs(args)).start()
+    thread = threading.Thread(target=agent.serve_forever, daemon=True)
+    thread.start()
+    yield agent
+    agent.shutdown()
+    agent.close()
+
+
+def test_agent_serves_reads(agent, fake_vault, values_file, capsys):
+    vault.main(['view', values_file])
+    assert "password: hunter2" in capsys.readouterr().out
+    reads = fake_vault.count("GET")
+
+    # The second run is served from the agent's cache, without a single request to Vault
+    vault.main(['view', values_file])
+    assert "password: hunter2" in capsys.readouterr().out
+    assert fake_vault.count("GET") == reads
+    assert agent.hits == 2
+
+    # --refresh reads through the agent, updating its cache
+    fake_vault.put_v2("secret", "app/password", {"value": "changed"})
+    vault.main(['view', values_file, '--refresh'])
+    assert "password: changed" in capsys.readouterr().out
+
+
+def test_agent_forgets_written_secrets(agent, values_file, tmp_path, capsys):
+    vault.main(['view', values_file])
+    capsys.readouterr()
+    secret_file = tmp_path / "values.yaml.dec"
+    secret_file.write_text("database:\n  user: admin\n  password: rotated\n")
+
+    vault.main(['enc', values_file, '-s', str(secret_file)])
+    vault.main(['view', values_file])
+
+    assert "password: rotated" in capsys.readouterr().out
+
+
+def test_agent_cache_eviction(agent, fake_vault):
+    agent.envs.cache_size = 1
+    user = ("secret", "app/user", "v2")
+    password = ("secret", "app/password", "v2")
+
+    assert agent.read(user) == ({"value": "admin"}, 1)
+    assert agent.read(password) == ({"value": "hunter2"}, 1)
+    assert list(agent.cache) == [password]
+
+    # Failed reads are not cached
+    with pytest.raises(Exception):
+        agent.read(("secret", "app/missing", "v2"))
+    assert list(agent.cache) == []
+
+
+def test_agent_rejects_other_clients(agent, fake_vault, values_file, monkeypatch, capsys):
+    monkeypatch.setenv("VAULT_TOKEN", "another-token")
+    assert "unavailable" in agent.handle(b'{"op": "read", "addr": "%s", "token": "%s"}' % (fake_vault.addr.encode(), vault.token_identity().encode()))
+    assert "unavailable" in agent.handle(b'{"op": "read", "addr": "http://elsewhere:8200"}')
+
+    # Such a client reads from Vault itself, with its own token
+    vault.main(['view', values_file])
+    assert "database" in capsys.readouterr().out
+    assert agent.misses == 0
+
+
+def test_stale_socket_falls_back_to_vault(fake_vault, values_file, tmp_path, capsys):
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(str(tmp_path / "agent.sock"))
+    stale.close()
+
+    vault.main(['view', values_file])
+
+    assert "password: hunter2" in capsys.readouterr().out
+
+
+def test_agent_renews_its_token(fake_vault, monkeypatch):
+    monkeypatch.setattr(vault.Agent, "RENEW_INTERVAL", 0.01)
+    fake_vault.token_info = dict(ttl=10, creation_ttl=100, renewable=True)
+    args, _ = vault.parse_args(['agent']).parse_known_args(['agent'])
+    agent = vault.Agent(args, vault.Envs(args)).start()
+    try:
+        deadline = time.time() + 5
+        while (fake_vault.renewals == 0) and (time.time() < deadline):
+            time.sleep(0.01)
+    finally:
+        agent.close()
+
+    # Renewed once, then left alone while more than half of the TTL remains
+    time.sleep(0.05)
+    assert fake_vault.renewals == 1
+    assert fake_vault.token_info["ttl"] == 100
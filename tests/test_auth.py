@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import stat
+import time
+
+import pytest
+
+import src.vault as vault
+
+
+@pytest.fixture
+def fake_vault(fake_vault, monkeypatch):
+    # No token given: the runs log in with AppRole
+    fake_vault.put_v2("secret", "app/password", {"value": "hunter2"})
+    monkeypatch.delenv("VAULT_TOKEN", raising=False)
+    monkeypatch.setenv("VAULT_AUTH_METHOD", "approle")
+    monkeypatch.setenv("VAULT_ROLE_ID", "fake-role-id")
+    monkeypatch.setenv("VAULT_SECRET_ID", "fake-secret-id")
+    return fake_vault
+
+
+@pytest.fixture
+def values_file(tmp_path):
+    values_file = tmp_path / "values.yaml"
+    values_file.write_text("password: VAULT:/secret/app/password\n")
+    return str(values_file)
+
+
+def token_files(tmp_path):
+    return list((tmp_path / "cache" / "auth").glob("token-*.json"))
+
+
+def test_approle_login_is_cached_between_runs(fake_vault, tmp_path, values_file, capsys):
+    fake_vault.token_info.update(creation_ttl=3600, renewable=True)
+
+    for _ in range(3):
+        vault.main(['view', values_file, '-kv', 'v2'])
+        assert capsys.readouterr().out == "password: hunter2\n"
+
+    assert fake_vault.logins == 1
+    [token_file] = token_files(tmp_path)
+    assert stat.S_IMODE(os.stat(token_file).st_mode) == 0o600
+    with open(token_file) as cached:
+        assert json.load(cached)["token"] == fake_vault.token
+
+
+def test_cached_token_outlives_secret_cache_eviction(fake_vault, tmp_path, values_file, capsys):
+    fake_vault.token_info.update(creation_ttl=3600, renewable=True)
+    vault.main(['view', values_file, '-kv', 'v2', '--cache-ttl', '60'])
+
+    # More cached secrets than VAULT_CACHE_SIZE, the least recently used evicted first
+    assert vault.evict_lru(str(tmp_path / "cache"), 0) >= 1
+    vault.main(['view', values_file, '-kv', 'v2'])
+
+    assert capsys.readouterr().out.endswith("password: hunter2\n")
+    assert fake_vault.logins == 1
+
+
+def test_kubernetes_login(fake_vault, tmp_path, values_file, capsys, monkeypatch):
+    jwt = tmp_path / "jwt"
+    jwt.write_text("fake-jwt\n")
+    monkeypatch.setenv("VAULT_AUTH_METHOD", "kubernetes")
+    monkeypatch.setenv("VAULT_ROLE", "fake-role")
+    monkeypatch.setenv("VAULT_K8S_TOKEN_FILE", str(jwt))
+
+    vault.main(['view', values_file, '-kv', 'v2'])
+
+    assert capsys.readouterr().out == "password: hunter2\n"
+    assert fake_vault.logins == 1
+
+
+def test_expiring_or_rejected_tokens_log_in_again(fake_vault, tmp_path, values_file, capsys):
+    fake_vault.token_info.update(creation_ttl=3600, renewable=True)
+    vault.main(['view', values_file, '-kv', 'v2'])
+
+    # Less than a tenth of its TTL left
+    [token_file] = token_files(tmp_path)
+    with open(token_file) as cached:
+        entry = json.load(cached)
+    with open(token_file, "w") as cached:
+        json.dump(dict(entry, expires=time.time() + 60), cached)
+    vault.main(['view', values_file, '-kv', 'v2'])
+    assert fake_vault.logins == 2
+
+    # A revoked token is dropped, the next run logs in again
+    fake_vault.token = "rotated-token"
+    vault.main(['view', values_file, '-kv', 'v2', '--retries', '0'])
+    assert token_files(tmp_path) == []
+    vault.main(['view', values_file, '-kv', 'v2'])
+    assert fake_vault.logins == 3
+    assert capsys.readouterr().out.endswith("password: hunter2\n")
+
+
+def test_keep_alive_renews_and_logs_in_again(fake_vault, tmp_path, monkeypatch):
+    fake_vault.token_info.update(creation_ttl=2, renewable=True)
+    args, _ = vault.parse_args(['view']).parse_known_args(['view', 'values.yaml', '-kv', 'v2'])
+    run = vault.Vault(args, vault.Envs(args))
+    run.client
+    assert fake_vault.logins == 1
+
+    # Renewed once half of the TTL has gone
+    deadline = time.time() + 5
+    while run.auth.renewals == 0 and time.time() < deadline:
+        time.sleep(0.1)
+    assert fake_vault.renewals >= 1
+
+    # Renewal no longer extends the token, which reached its maximum TTL: log in again
+    fake_vault.token_info.update(creation_ttl=0)
+    deadline = time.time() + 5
+    while fake_vault.logins == 1 and time.time() < deadline:
+        time.sleep(0.1)
+    assert fake_vault.logins == 2
+
+
+def test_bad_credentials(fake_vault, values_file, monkeypatch):
+    monkeypatch.setenv("VAULT_SECRET_ID", "wrong")
+    with pytest.raises(Exception, match="login with approle at auth/approle failed"):
+        vault.main(['view', values_file, '-kv', 'v2'])
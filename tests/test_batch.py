@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import src.vault as vault
+
+VAULT_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src", "vault.py")
+
+
+@pytest.fixture
+def environment(fake_vault, stub_helm, tmp_path, monkeypatch):
+    output = []
+    monkeypatch.setattr(vault, "print", lambda s : output.append(s), raising=False)
+
+    # Stub helm recording its arguments and the values it was given in helm-<chart>.log, failing for the broken chart
+    stub_helm(f"""for arg in "$@"; do [ "$arg" = "-f" ] && break; chart=$(basename "$arg"); done
+out={tmp_path}/helm-$chart.log
+echo "$@" > $out
+while [ $# -gt 0 ]; do [ "$1" = "-f" ] && cat "$2" >> $out; shift; done
+case "$out" in *broken*) echo "Error: chart not found" >&2; exit 1;; esac
+""")
+    yield fake_vault, output
+
+
+def test_batch(environment, tmp_path):
+    server, output = environment
+    server.put_v2("secret", "app/prod/password", {"value": "prod-password"})
+    server.put_v2("secret", "app/staging/password", {"value": "staging-password"})
+    (tmp_path / "values.yaml").write_text("password: VAULT:/secret/app/{environment}/password\n")
+    manifest = tmp_path / "releases.yaml"
+    manifest.write_text(f"""releases:
+  - name: web
+    chart: ./web
+    values: {tmp_path}/values.yaml
+    environment: prod
+    args: --namespace web
+  - name: worker
+    action: template
+    chart: ./worker
+    values: [{tmp_path}/values.yaml]
+    environment: staging
+  - name: broken
+    chart: ./broken
+""")
+    report_file = tmp_path / "report.json"
+
+    with pytest.raises(Exception, match="1 of 3 releases failed: broken"):
+        vault.main(['batch', str(manifest), '--report-file', str(report_file)])
+
+    web = (tmp_path / "helm-web.log").read_text()
+    assert web.startswith("upgrade --namespace web web ./web -f /dev/fd/")
+    assert "password: prod-password" in web
+    assert "password: staging-password" in (tmp_path / "helm-worker.log").read_text()
+
+    with open(report_file) as report:
+        results = {release["name"]: release for release in json.load(report)}
+    assert results["web"]["result"] == "ok"
+    assert results["worker"]["secrets"] == 1
+    assert results["broken"]["returncode"] == 1
+    assert "Error: chart not found" in output[-1]
+    assert "prod-password" not in " ".join(output)
+
+
+def test_batch_manifest_errors(environment, tmp_path):
+    manifest = tmp_path / "releases.yaml"
+    manifest.write_text("releases:\n  - name: web\n    action: rollback\n    chart: ./web\n")
+    with pytest.raises(Exception, match="action must be one of"):
+        vault.main(['batch', str(manifest)])
+
+    manifest.write_text("releases: []\n")
+    with pytest.raises(Exception, match="must hold a list of releases"):
+        vault.main(['batch', str(manifest)])
+
+
+def test_batch_exit_status(environment, tmp_path):
+    # The pipeline running the batch only sees its exit status
+    server, output = environment
+    server.put_v2("secret", "app/prod/password", {"value": "prod-password"})
+    (tmp_path / "values.yaml").write_text("password: VAULT:/secret/app/{environment}/password\n")
+    release = f"  - name: web\n    chart: ./web\n    values: {tmp_path}/values.yaml\n    environment: prod\n"
+    manifest = tmp_path / "releases.yaml"
+
+    manifest.write_text(f"releases:\n{release}")
+    assert subprocess.run([sys.executable, VAULT_SCRIPT, "batch", str(manifest)], capture_output=True, text=True).returncode == 0
+
+    manifest.write_text(f"releases:\n{release}  - name: broken\n    chart: ./broken\n")
+    result = subprocess.run([sys.executable, VAULT_SCRIPT, "batch", str(manifest)], capture_output=True, text=True)
+    assert result.returncode == 1
+    assert "1 of 2 releases failed: broken" in result.stdout
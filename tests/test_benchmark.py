@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import time
+
+import pytest
+
+import src.vault as vault
+from tests.fake_vault import FakeVault
+
+# Synthetic values files: (scalar nodes, placeholders)
+# The 50k node case takes a while, it only runs with HELM_VAULT_BENCHMARK=all
+SIZES = {
+    "10": (10, 2),
+    "1k": (1000, 1000),
+    "50k": (50000, 5000),
+}
+DEFAULT_SIZES = ["10", "1k"]
+
+THRESHOLDS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_thresholds.json")
+
+# Results of every benchmark of the session, written as JSON to HELM_VAULT_BENCHMARK_RESULTS when set
+RESULTS = {}
+
+
+def selected_sizes():
+    return list(SIZES) if os.environ.get("HELM_VAULT_BENCHMARK") == "all" else DEFAULT_SIZES
+
+
+def synthetic_values(nodes, placeholders):
+    # Nested sections of scalars, with placeholders spread evenly; returns (values, secrets) YAML texts
+    step = max(nodes // placeholders, 1)
+    values, secrets = [], []
+    placed = 0
+    for node in range(nodes):
+        if node % 100 == 0:
+            values.append(f"section{node // 100}:")
+            secrets.append(values[-1])
+        if node % 10 == 0:
+            values.append(f"  group{(node // 10) % 10}:")
+            secrets.append(values[-1])
+        if (node % step == 0) and (placed < placeholders):
+            values.append(f"    key{node}: changeme")
+            secrets.append(f"    key{node}: secret-{node}")
+            placed += 1
+        else:
+            values.append(f"    key{node}: value-{node}")
+            secrets.append(values[-1])
+    return "\n".join(values) + "\n", "\n".join(secrets) + "\n"
+
+
+@pytest.fixture(scope="module")
+def fake_vault():
+    with FakeVault() as server:
+        yield server
+
+
+@pytest.fixture
+def environment(fake_vault, stub_helm, tmp_path, monkeypatch):
+    monkeypatch.setenv("VAULT_ADDR", fake_vault.addr)
+    monkeypatch.setenv("VAULT_TOKEN", fake_vault.token)
+    monkeypatch.setenv("KVVERSION", "v2")
+    monkeypatch.setenv("VAULT_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(vault, "print", lambda s : None, raising=False)
+
+    # Stub helm that reads every -f file it is given
+    stub_helm('while [ $# -gt 0 ]; do [ "$1" = "-f" ] && cat "$2" > /dev/null; shift; done\n')
+    return tmp_path
+
+
+def values_files(directory, size):
+    values, secrets = synthetic_values(*SIZES[size])
+    values_file = directory / f"values-{size}.yaml"
+    values_file.write_text(values)
+    secret_file = directory / f"values-{size}.yaml.dec"
+    secret_file.write_text(secrets)
+    return str(values_file), str(secret_file)
+
+
+def timed(argv):
+    start = time.perf_counter()
+    vault.main(argv)
+    return time.perf_counter() - start
+
+
+def record(operation, size, elapsed):
+    with open(THRESHOLDS_FILE) as thresholds_file:
+        threshold = json.load(thresholds_file)[operation][size]
+    RESULTS.setdefault(operation, {})[size] = dict(seconds=round(elapsed, 4), threshold=threshold, passed=elapsed <= threshold)
+    results_file = os.environ.get("HELM_VAULT_BENCHMARK_RESULTS")
+    if results_file:
+        with open(results_file, "w") as output:
+            json.dump(RESULTS, output, indent=2, sort_keys=True)
+    assert elapsed <= threshold, f"{operation} on {size} nodes took {elapsed:.3f}s, threshold is {threshold}s"
+
+
+@pytest.mark.parametrize("size", selected_sizes())
+def test_benchmark_enc(environment, size):
+    values_file, secret_file = values_files(environment, size)
+    record("enc", size, timed(['enc', values_file, '-s', secret_file]))
+
+
+@pytest.mark.parametrize("size", selected_sizes())
+def test_benchmark_dec(environment, size):
+    values_file, secret_file = values_files(environment, size)
+    vault.main(['enc', values_file, '-s', secret_file])
+    os.remove(secret_file)
+
+    elapsed = timed(['dec', values_file])
+
+    with open(f"{values_file}.dec") as decrypted:
+        assert "changeme" not in decrypted.read()
+    record("dec", size, elapsed)
+
+
+@pytest.mark.parametrize("size", selected_sizes())
+def test_benchmark_view(environment, size, capsys):
+    values_file, secret_file = values_files(environment, size)
+    vault.main(['enc', values_file, '-s', secret_file])
+    capsys.readouterr()
+
+    elapsed = timed(['view', values_file])
+
+    assert "changeme" not in capsys.readouterr().out
+    record("view", size, elapsed)
+
+
+@pytest.mark.parametrize("size", selected_sizes())
+def test_benchmark_upgrade(environment, size):
+    values_file, secret_file = values_files(environment, size)
+    vault.main(['enc', values_file, '-s', secret_file])
+    record("upgrade", size, timed(['upgrade', 'release', './chart', '-f', values_file]))
+
+
+def test_benchmark_dec_latency(environment, fake_vault, monkeypatch):
+    # 200 secrets behind 20ms of latency: sequential reads would take 4s
+    values, secrets = synthetic_values(200, 200)
+    values_file = environment / "latency.yaml"
+    values_file.write_text(values)
+    secret_file = environment / "latency.yaml.dec"
+    secret_file.write_text(secrets)
+    vault.main(['enc', str(values_file), '-s', str(secret_file)])
+    os.remove(secret_file)
+
+    monkeypatch.setattr(fake_vault, "latency", 0.02)
+    record("dec_latency", "200", timed(['dec', str(values_file), '--parallel', '20']))
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+import json
+
+import pytest
+
+import src.vault as vault
+from tests.fake_vault import FakeVault
+
+
+@pytest.fixture
+def cluster(tmp_path, monkeypatch):
+    # An active node and two performance standbys, all three serving the same data
+    active, standbys = FakeVault().start(), [FakeVault(standby=True).start() for _ in range(2)]
+    for standby in standbys:
+        standby.kv2 = active.kv2
+    monkeypatch.setenv("VAULT_ADDR", active.addr)
+    monkeypatch.setenv("VAULT_ADDRS", ",".join(node.addr for node in [active] + standbys))
+    monkeypatch.setenv("VAULT_TOKEN", active.token)
+    monkeypatch.setenv("VAULT_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(vault, "print", lambda s : None, raising=False)
+    yield active, standbys
+    for node in [active] + standbys:
+        try:
+            node.stop()
+        except OSError:
+            pass
+
+
+def values(tmp_path, count):
+    values_file = tmp_path / "values.yaml"
+    values_file.write_text("".join(f"key{n}: VAULT:/secret/app/key{n}\n" for n in range(count)))
+    secret_file = tmp_path / "values.yaml.dec"
+    secret_file.write_text("".join(f"key{n}: secret-{n}\n" for n in range(count)))
+    return str(values_file), str(secret_file)
+
+
+def data_requests(node, method):
+    return len([path for (request_method, path) in node.requests if request_method == method and "/sys/" not in path])
+
+
+def expected(count):
+    return "".join(f"key{n}: secret-{n}\n" for n in range(count))
+
+
+def test_writes_go_to_the_active_node_and_reads_to_the_standbys(cluster, tmp_path, capsys):
+    active, standbys = cluster
+    values_file, secret_file = values(tmp_path, 20)
+
+    vault.main(['enc', values_file, '-s', secret_file, '-kv', 'v2'])
+    assert data_requests(active, "POST") == 20
+    assert [data_requests(standby, "GET") + data_requests(standby, "POST") for standby in standbys] == [0, 0]
+
+    reads = data_requests(active, "GET")
+    vault.main(['view', values_file, '-kv', 'v2', '--no-cache'])
+
+    assert capsys.readouterr().out == expected(20)
+    assert data_requests(active, "GET") == reads
+    assert all(data_requests(standby, "GET") >= 10 for standby in standbys)
+
+
+def test_edit_reads_and_writes_on_the_active_node(cluster, tmp_path, monkeypatch):
+    active, standbys = cluster
+    values_file, secret_file = values(tmp_path, 5)
+    vault.main(['enc', values_file, '-s', secret_file, '-kv', 'v2'])
+
+    def edit(command):
+        decode_file = command.split(" ")[-1]
+        with open(decode_file) as edited:
+            text = edited.read().replace("secret-2\n", "rotated-2\n")
+        with open(decode_file, "w") as edited:
+            edited.write(text)
+        return 0
+    monkeypatch.setattr(vault.os, "system", edit)
+    vault.main(['edit', values_file, '-kv', 'v2', '--no-cache'])
+
+    assert active.get_v2("secret", "app/key2") == {"value": "rotated-2"}
+    assert [data_requests(standby, "GET") for standby in standbys] == [0, 0]
+
+
+def test_failover_leaves_a_dead_node_out(cluster, tmp_path, capsys):
+    active, standbys = cluster
+    values_file, secret_file = values(tmp_path, 10)
+    vault.main(['enc', values_file, '-s', secret_file, '-kv', 'v2'])
+    vault.main(['view', values_file, '-kv', 'v2', '--no-cache'])
+    capsys.readouterr()
+
+    # The health cache still has the node as healthy: its failed requests go to the other standby
+    standbys[0].stop()
+    vault.main(['view', values_file, '-kv', 'v2', '--no-cache', '--retries', '0'])
+
+    assert capsys.readouterr().out == expected(10)
+    with open(tmp_path / "cache" / "cluster" / "health.json") as health_file:
+        health = json.load(health_file)
+    assert health[standbys[0].addr]["status"] is None
+    assert health[standbys[1].addr]["status"] == 473
+    assert health[active.addr]["status"] == 200
+
+
+def test_latency_balance_prefers_the_fastest_standby(cluster, tmp_path, capsys):
+    active, standbys = cluster
+    standbys[0].latency = 0.05
+    values_file, secret_file = values(tmp_path, 20)
+    vault.main(['enc', values_file, '-s', secret_file, '-kv', 'v2'])
+
+    vault.main(['view', values_file, '-kv', 'v2', '--no-cache', '--balance', 'latency'])
+
+    assert capsys.readouterr().out == expected(20)
+    assert data_requests(standbys[1], "GET") > data_requests(standbys[0], "GET")
+
+
+def test_missing_secrets_do_not_hold_nodes_pending(cluster):
+    # A 404 is an answer, not a node failure, and mustn't count against the node for the latency balance
+    args, _ = vault.parse_args(['view', 'values.yaml']).parse_known_args(['view', 'values.yaml', '-kv', 'v2'])
+    client = vault.Vault(args, vault.Envs(args)).client
+
+    for n in range(5):
+        with pytest.raises(vault.SecretNotFound):
+            client.read("v2", "secret", f"app/missing{n}")
+
+    assert set(client.pending.values()) == {0}
+    assert len(client.readers) == 2
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import os
+
+import pytest
+
+import src.vault as vault
+
+
+@pytest.fixture
+def fake_vault(fake_vault):
+    for n in range(20):
+        fake_vault.put_v2("secret", f"app/key{n}", {"value": f"secret-{n}"})
+    return fake_vault
+
+
+@pytest.fixture
+def values_file(tmp_path):
+    values_file = tmp_path / "values.yaml"
+    values_file.write_text("app:\n" + "".join(f"  key{n}: VAULT:/secret/app/key{n}\n" for n in range(20)))
+    return str(values_file)
+
+
+def editor(monkeypatch, change):
+    # Stands in for the editor: change(text) is what the user saves
+    def edit(command):
+        decode_file = command.split(" ")[-1]
+        with open(decode_file) as edited:
+            text = change(edited.read())
+        with open(decode_file, "w") as edited:
+            edited.write(text)
+        return 0
+    monkeypatch.setattr(vault.os, "system", edit)
+
+
+@pytest.mark.parametrize("engine", ["text", "yaml"])
+def test_edit_writes_back_only_changed_secrets(fake_vault, values_file, monkeypatch, engine):
+    editor(monkeypatch, lambda text: text.replace("secret-3\n", "rotated-3\n"))
+    writes = fake_vault.count("POST")
+
+    vault.main(['edit', values_file, '-kv', 'v2', '--engine', engine])
+
+    assert fake_vault.count("POST") == writes + 1
+    assert fake_vault.get_v2("secret", "app/key3") == {"value": "rotated-3"}
+    assert fake_vault.get_v2("secret", "app/key4") == {"value": "secret-4"}
+    assert not os.path.exists(f"{values_file}.dec")
+
+
+def test_edit_without_changes_writes_nothing(fake_vault, values_file, monkeypatch):
+    editor(monkeypatch, lambda text: text)
+    writes = fake_vault.count("POST")
+
+    vault.main(['edit', values_file, '-kv', 'v2'])
+
+    assert fake_vault.count("POST") == writes
+    assert not os.path.exists(f"{values_file}.dec")
+
+
+def test_edit_does_not_overwrite_concurrent_changes(fake_vault, values_file, monkeypatch):
+    def change(text):
+        # Someone else rotates key5 while the editor is open
+        fake_vault.put_v2("secret", "app/key5", {"value": "theirs"})
+        return text.replace("secret-5\n", "mine\n").replace("secret-6\n", "rotated-6\n")
+    editor(monkeypatch, change)
+
+    with pytest.raises(Exception, match="1 changed or removed secret"):
+        vault.main(['edit', values_file, '-kv', 'v2'])
+
+    assert fake_vault.get_v2("secret", "app/key5") == {"value": "theirs"}
+    assert fake_vault.get_v2("secret", "app/key6") == {"value": "rotated-6"}
+    with open(f"{values_file}.dec") as kept:
+        assert "key5: mine" in kept.read()
+
+
+@pytest.mark.parametrize("engine", ["text", "yaml"])
+def test_edit_writes_back_secrets_in_lists(fake_vault, tmp_path, monkeypatch, engine):
+    values_file = tmp_path / "deployment.yaml"
+    values_file.write_text("env:\n- name: A\n  value: VAULT:/secret/app/key1\n- name: B\n  value: VAULT:/secret/app/key2\n")
+    editor(monkeypatch, lambda text: text.replace("secret-2\n", "rotated-2\n"))
+
+    vault.main(['edit', str(values_file), '-kv', 'v2', '--engine', engine])
+
+    assert fake_vault.get_v2("secret", "app/key2") == {"value": "rotated-2"}
+    assert fake_vault.get_v2("secret", "app/key1") == {"value": "secret-1"}
+    assert not os.path.exists(f"{values_file}.dec")
+
+
+def test_edit_keeps_the_file_when_a_secret_was_removed(fake_vault, values_file, monkeypatch):
+    editor(monkeypatch, lambda text: text.replace("  key7: secret-7\n", "").replace("secret-8\n", "rotated-8\n"))
+
+    with pytest.raises(Exception, match="1 changed or removed secret"):
+        vault.main(['edit', values_file, '-kv', 'v2'])
+
+    assert fake_vault.get_v2("secret", "app/key8") == {"value": "rotated-8"}
+    assert fake_vault.get_v2("secret", "app/key7") == {"value": "secret-7"}
+    assert os.path.exists(f"{values_file}.dec")
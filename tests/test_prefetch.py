@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+import pytest
+
+import src.vault as vault
+
+
+@pytest.fixture
+def fake_vault(fake_vault, tmp_path, monkeypatch):
+    # Values of a chart whose git root is named chart, so its secrets sit under secret/helm/chart
+    chart = tmp_path / "chart"
+    (chart / ".git").mkdir(parents=True)
+    (chart / "values.yaml").write_text("database:\n  user: changeme\n  password: changeme\n")
+    monkeypatch.chdir(chart)
+    return fake_vault
+
+
+def test_prefetch_reports_unused_and_missing_secrets(fake_vault, capsys):
+    fake_vault.put_v2("secret", "secret/helm/chart/database/user", {"value": "admin"})
+    fake_vault.put_v2("secret", "secret/helm/chart/old/token", {"value": "unused"})
+
+    vault.main(['view', 'values.yaml', '--prefetch'])
+
+    captured = capsys.readouterr()
+    assert "user: admin" in captured.out
+    assert captured.err.splitlines() == [
+        "Prefetch: listed 3 folders, read 1 secrets, 1 unused, 1 missing",
+        "Unused secret: secret/helm/chart/old/token",
+        "Missing secret: secret/helm/chart/database/password",
+    ]
+    # The listing showed the password missing, so it was never requested
+    assert ("GET", "/v1/secret/data/secret/helm/chart/database/password") not in fake_vault.requests
+
+
+def test_prefetch_packed_layout(fake_vault, capsys):
+    fake_vault.put_v2("secret", "secret/helm/chart", {"database/user": "admin", "database/password": "hunter2", "old/token": "unused"})
+
+    vault.main(['view', 'values.yaml', '--prefetch', '--layout', 'packed'])
+
+    captured = capsys.readouterr()
+    assert "password: hunter2" in captured.out
+    assert "Unused secret: secret/helm/chart (old/token)" in captured.err.splitlines()
+
+
+def test_listed_as_missing():
+    listings = {"a": ["b/", "c"], "a/b": None}
+
+    assert vault.listed_as_missing(listings, "a", "a/c") is False
+    assert vault.listed_as_missing(listings, "a", "a/d") is True
+    assert vault.listed_as_missing(listings, "a", "a/e/f") is True
+    assert vault.listed_as_missing(listings, "a", "a/b/g") is True
+    # Deeper than what was listed: unknown, so the secret is read
+    assert vault.listed_as_missing({"a": ["b/"]}, "a", "a/b/g") is False
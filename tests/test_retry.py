@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import subprocess
+import sys
+import time
+from email.utils import formatdate
+
+import pytest
+import requests
+
+import src.vault as vault
+
+VAULT_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src", "vault.py")
+
+
+def policy(retries=4, rate_limit=0):
+    args, _ = vault.parse_args(['dec', 'values.yaml']).parse_known_args(['dec', 'values.yaml'])
+    envs = vault.Envs(args)
+    envs.retries = retries
+    envs.rate_limit = rate_limit
+    return vault.RequestPolicy(envs, vault.Metrics())
+
+
+def test_retry_after():
+    assert vault.retry_after(None) is None
+    assert vault.retry_after("2") == 2.0
+    assert vault.retry_after("-1") == 0.0
+    assert 8 < vault.retry_after(formatdate(time.time() + 10, usegmt=True)) <= 10
+    assert vault.retry_after("soon") is None
+
+
+def test_rate_limited_reads_are_retried(fake_vault, values_file, tmp_path, capsys):
+    fake_vault.put_v2("secret", "app/user", {"value": "admin"})
+    fake_vault.put_v2("secret", "app/password", {"value": "hunter2"})
+    fake_vault.error_status = 429
+    fake_vault.retry_after = 0
+    fake_vault.failures = 3
+    metrics_file = str(tmp_path / "metrics.json")
+
+    vault.main(['view', values_file, '--parallel', '1', '--metrics-file', metrics_file])
+
+    decrypted = capsys.readouterr().out
+    assert "user: admin" in decrypted
+    assert "password: hunter2" in decrypted
+    with open(metrics_file) as metrics:
+        assert json.load(metrics)["vault"]["retries"] == 3
+
+
+def test_wrapper_does_not_run_helm_with_missing_secrets(fake_vault, values_file, stub_helm, tmp_path, monkeypatch):
+    fake_vault.put_v2("secret", "app/user", {"value": "admin"})
+    fake_vault.failures = 100
+    stub_helm(f"touch {tmp_path}/helm-ran\n")
+    monkeypatch.setattr(vault.RequestPolicy, "BACKOFF_BASE", 0.001)
+
+    with pytest.raises(Exception, match="could not be read from Vault"):
+        vault.main(['template', './chart', '-f', values_file, '--retries', '1'])
+    assert not os.path.exists(tmp_path / "helm-ran")
+
+
+def test_wrapper_does_not_run_helm_with_missing_packed_fields(fake_vault, stub_helm, tmp_path, monkeypatch):
+    # The packed secret exists, but doesn't hold the password yet
+    (tmp_path / ".git").mkdir()
+    monkeypatch.chdir(tmp_path)
+    fake_vault.put_v2("secret", f"secret/helm/{tmp_path.name}", {"database/user": "admin"})
+    values_file = tmp_path / "packed.yaml"
+    values_file.write_text("database:\n  user: changeme\n  password: changeme\n")
+    stub_helm(f"touch {tmp_path}/helm-ran\n")
+
+    with pytest.raises(Exception, match="1 secret\\(s\\) could not be read from Vault"):
+        vault.main(['template', './chart', '-f', str(values_file), '--layout', 'packed'])
+    assert not os.path.exists(tmp_path / "helm-ran")
+
+
+@pytest.mark.parametrize("delivery", ["memory", "file"])
+def test_streaming_wrapper_does_not_run_helm_with_missing_secrets(fake_vault, values_file, stub_helm, tmp_path, delivery):
+    # Streamed documents are read from Vault while being handed to helm, after the first check
+    fake_vault.put_v2("secret", "app/user", {"value": "admin"})
+    stub_helm(f"touch {tmp_path}/helm-ran\n")
+
+    with pytest.raises(Exception, match="could not be read from Vault"):
+        vault.main(['template', './chart', '-f', values_file, '--stream', '--delivery', delivery])
+    assert not os.path.exists(tmp_path / "helm-ran")
+    assert not os.path.exists(f"{values_file}.dec")
+
+
+def test_wrapper_exit_status(fake_vault, values_file, stub_helm, tmp_path):
+    # Pipelines only see the exit status, a run that didn't deploy must not exit 0
+    fake_vault.put_v2("secret", "app/user", {"value": "admin"})
+    stub_helm("exit 3\n")
+    command = [sys.executable, VAULT_SCRIPT, "template", "./chart", "-f", values_file]
+
+    result = subprocess.run(command, capture_output=True, text=True)
+    assert result.returncode == 1
+    assert "helm was not run" in result.stdout
+
+    fake_vault.put_v2("secret", "app/password", {"value": "hunter2"})
+    assert subprocess.run(command, capture_output=True, text=True).returncode == 3
+
+
+def test_circuit_breaker(monkeypatch):
+    monkeypatch.setenv("VAULT_ADDR", "http://vault:8200")
+    monkeypatch.setattr(vault.RequestPolicy, "BACKOFF_BASE", 0.001)
+    request_policy = policy(retries=1)
+    sent = []
+
+    def send(request, **kwargs):
+        sent.append(request)
+        raise requests.exceptions.ConnectionError("connection refused")
+
+    request = requests.Request("GET", "http://vault:8200/v1/secret/data/app").prepare()
+    for _ in range(vault.RequestPolicy.BREAKER_THRESHOLD):
+        with pytest.raises(requests.exceptions.ConnectionError):
+            request_policy.send(send, request)
+    assert len(sent) == 2 * vault.RequestPolicy.BREAKER_THRESHOLD
+
+    # Open: failing at once, without reaching Vault
+    with pytest.raises(vault.CircuitOpen):
+        request_policy.send(send, request)
+    assert len(sent) == 2 * vault.RequestPolicy.BREAKER_THRESHOLD
+
+    # Half open once the cooldown is over: a successful probe closes the circuit
+    request_policy.opened_until = 0
+    response = requests.Response()
+    response.status_code = 200
+    assert request_policy.send(lambda request, **kwargs: response, request) is response
+    assert request_policy.failures == 0
+
+
+def test_token_bucket():
+    bucket = vault.TokenBucket(rate=50, capacity=1)
+    start = time.monotonic()
+    for _ in range(11):
+        bucket.acquire()
+    assert time.monotonic() - start >= 0.19
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+import os
+
+import pytest
+
+import src.vault as vault
+
+
+@pytest.fixture
+def fake_vault(fake_vault, monkeypatch):
+    monkeypatch.setenv("VAULT_SNAPSHOT_KEY", "pipeline-key")
+    fake_vault.put_v2("secret", "app/prod/password", {"value": "prod-password"})
+    fake_vault.put_v2("secret", "app/staging/password", {"value": "staging-password"})
+    return fake_vault
+
+
+@pytest.fixture
+def values_file(tmp_path):
+    values_file = tmp_path / "values.yaml"
+    values_file.write_text("password: VAULT:/secret/app/{environment}/password\n")
+    return str(values_file)
+
+
+def test_snapshot(fake_vault, values_file, tmp_path, monkeypatch):
+    bundle = str(tmp_path / "secrets.snapshot")
+    vault.main(['snapshot', bundle, '-f', values_file, '-e', 'prod', '-e', 'staging'])
+    assert os.stat(bundle).st_mode & 0o077 == 0
+    with open(bundle, "rb") as snapshot:
+        assert b"prod-password" not in snapshot.read()
+
+    # Reading from the bundle needs neither Vault nor its address
+    requests = len(fake_vault.requests)
+    monkeypatch.delenv("VAULT_ADDR")
+    monkeypatch.delenv("VAULT_TOKEN")
+    vault.main(['dec', values_file, '-e', 'staging', '--snapshot', bundle])
+    with open(f"{values_file}.staging.dec") as decrypted:
+        assert decrypted.read() == "password: staging-password\n"
+    assert len(fake_vault.requests) == requests
+
+    # Secrets that aren't in the bundle are missing, not read from Vault
+    with pytest.raises(Exception, match="could not be read from Vault, helm was not run"):
+        vault.main(['install', 'release', './chart', '-f', values_file, '-e', 'dev', '--snapshot', bundle])
+
+    monkeypatch.setenv("VAULT_SNAPSHOT_KEY", "another-key")
+    with pytest.raises(Exception, match="can't be decrypted with this key"):
+        vault.main(['dec', values_file, '-e', 'prod', '--snapshot', bundle])
+
+
+def test_snapshot_with_missing_secrets(fake_vault, values_file, tmp_path):
+    bundle = tmp_path / "secrets.snapshot"
+
+    with pytest.raises(Exception, match="1 secret\\(s\\) could not be read from Vault, no snapshot was written"):
+        vault.main(['snapshot', str(bundle), '-f', values_file, '-e', 'prod', '-e', 'dev'])
+    assert not bundle.exists()
+
+
+def test_snapshot_transit_key(fake_vault, values_file, tmp_path, monkeypatch):
+    monkeypatch.delenv("VAULT_SNAPSHOT_KEY")
+    bundle = str(tmp_path / "secrets.snapshot")
+    vault.main(['snapshot', bundle, '-f', values_file, '-e', 'prod', '--transit-key', 'transit/helm'])
+
+    # Only the data key is decrypted by Vault
+    requests = len(fake_vault.requests)
+    vault.main(['dec', values_file, '-e', 'prod', '--snapshot', bundle])
+    with open(f"{values_file}.prod.dec") as decrypted:
+        assert decrypted.read() == "password: prod-password\n"
+    assert fake_vault.requests[requests:] == [("POST", "/v1/transit/decrypt/helm")]
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+VAULT_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src", "vault.py")
+
+# Modules only the subcommands talking to Vault or reading YAML may import
+DEFERRED_MODULES = ["hvac", "requests", "ruamel.yaml", "git", "subprocess", "concurrent.futures"]
+
+# Startup budget on top of a bare interpreter, in milliseconds
+STARTUP_BUDGET_MS = 150
+
+
+def imported_modules(args, cwd):
+    # python -X importtime reports every module imported, on stderr
+    result = subprocess.run([sys.executable, "-X", "importtime", VAULT_SCRIPT] + args, cwd=cwd, capture_output=True, text=True)
+    modules = set()
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            modules.add(line.split("|")[-1].strip())
+    return modules
+
+
+def fastest_run(args, cwd, runs=5):
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(args, cwd=cwd, capture_output=True)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+
+@pytest.fixture
+def clean_target(tmp_path):
+    (tmp_path / "values.yaml").write_text("password: changeme\n")
+    return tmp_path
+
+
+@pytest.mark.parametrize("args", [["--help"], ["clean", "-f", "values.yaml"]])
+def test_startup_defers_heavy_imports(args, clean_target):
+    (clean_target / "values.yaml.dec").write_text("password: secret\n")
+    modules = imported_modules(args, str(clean_target))
+
+    assert "argparse" in modules
+    assert [module for module in DEFERRED_MODULES if module in modules] == []
+
+
+def test_startup_time_budget(clean_target):
+    baseline = fastest_run([sys.executable, "-c", "pass"], str(clean_target))
+    startup = fastest_run([sys.executable, VAULT_SCRIPT, "--help"], str(clean_target))
+
+    assert startup - baseline < STARTUP_BUDGET_MS, f"Startup took {startup - baseline:.0f}ms over a bare interpreter, budget is {STARTUP_BUDGET_MS}ms"
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+import src.vault as vault
+
+VAULT_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src", "vault.py")
+
+
+def values(tmp_path, count, mount):
+    values_file = tmp_path / "values.yaml"
+    values_file.write_text("".join(f"key{n}: VAULT:/{mount}/app/key{n}\n" for n in range(count)))
+    secret_file = tmp_path / "values.yaml.dec"
+    secret_file.write_text("".join(f"key{n}: secret-{n}\n" for n in range(count)))
+    return str(values_file), str(secret_file)
+
+
+@pytest.mark.parametrize("transport", ["native", "hvac"])
+@pytest.mark.parametrize("kvversion,mount", [("v1", "kv"), ("v2", "secret")])
+def test_transports(fake_vault, tmp_path, capsys, transport, kvversion, mount):
+    values_file, secret_file = values(tmp_path, 3, mount)
+    options = ['--transport', transport, '-kv', kvversion]
+
+    vault.main(['enc', values_file, '-s', secret_file] + options)
+    vault.main(['view', values_file] + options)
+
+    assert capsys.readouterr().out == "key0: secret-0\nkey1: secret-1\nkey2: secret-2\n"
+    if kvversion == "v2":
+        assert fake_vault.get_v2("secret", "app/key1") == {"value": "secret-1"}
+    else:
+        assert fake_vault.kv1["app/key1"] == {"value": "secret-1"}
+
+
+def test_native_transport_keeps_connections_alive(fake_vault, tmp_path, capsys):
+    values_file, secret_file = values(tmp_path, 50, "secret")
+    vault.main(['enc', values_file, '-s', secret_file, '-kv', 'v2'])
+    fake_vault.connections.clear()
+
+    vault.main(['view', values_file, '-kv', 'v2', '--parallel', '4'])
+
+    assert "key49: secret-49" in capsys.readouterr().out
+    assert fake_vault.count("GET") >= 100
+    assert len(fake_vault.connections) <= 4
+
+
+def test_native_transport_errors(fake_vault, tmp_path, monkeypatch):
+    args, _ = vault.parse_args(['view', 'values.yaml']).parse_known_args(['view', 'values.yaml'])
+    envs = vault.Envs(args)
+    client = vault.Vault(args, envs).client
+
+    with pytest.raises(vault.SecretNotFound):
+        client.read("v2", "secret", "app/missing")
+    assert client.list("v2", "secret", "app") is None
+    assert client.current_version("secret", "app/missing") == 0
+
+    client.write("v2", "secret", "app/key", {"value": "one"}, cas=0)
+    with pytest.raises(vault.VaultRequestError, match="check-and-set"):
+        client.write("v2", "secret", "app/key", {"value": "two"}, cas=0)
+    assert client.list("v2", "secret", "app") == ["key"]
+
+    monkeypatch.setenv("VAULT_TOKEN", "wrong-token")
+    with pytest.raises(vault.VaultRequestError, match="permission denied"):
+        vault.Vault(args, envs).client.read("v2", "secret", "app/key")
+
+
+def test_native_transport_skips_hvac_and_requests(fake_vault, tmp_path):
+    values_file, secret_file = values(tmp_path, 1, "secret")
+    fake_vault.put_v2("secret", "app/key0", {"value": "secret-0"})
+    env = dict(os.environ, KVVERSION="v2")
+
+    result = subprocess.run([sys.executable, "-X", "importtime", VAULT_SCRIPT, "view", values_file], env=env, capture_output=True, text=True)
+
+    assert result.stdout == "key0: secret-0\n"
+    modules = {line.split("|")[-1].strip() for line in result.stderr.splitlines() if line.startswith("import time:")}
+    assert "hvac" not in modules
+    assert "requests" not in modules
+
+
+def test_native_transport_trusts_the_requests_ca_bundle(tmp_path, monkeypatch):
+    # Users trusting their CA through requests' variables keep verifying Vault's certificate
+    pytest.importorskip("cryptography")
+    import datetime
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(x509.NameOID.COMMON_NAME, "Internal CA")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key())
+                   .serial_number(x509.random_serial_number()).not_valid_before(now).not_valid_after(now + datetime.timedelta(days=1))
+                   .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True).sign(key, hashes.SHA256()))
+    bundle = tmp_path / "ca.pem"
+    bundle.write_bytes(certificate.public_bytes(serialization.Encoding.PEM))
+    for variable in ["VAULT_CACERT", "VAULT_CAPATH", "REQUESTS_CA_BUNDLE", "CURL_CA_BUNDLE"]:
+        monkeypatch.delenv(variable, raising=False)
+
+    def trusted():
+        context = vault.NativeTransport("https://vault:8200", "token", None, None).context
+        return [dict(entry[0] for entry in ca["subject"]).get("commonName") for ca in context.get_ca_certs()]
+
+    monkeypatch.setenv("CURL_CA_BUNDLE", str(bundle))
+    assert trusted() == ["Internal CA"]
+    monkeypatch.setenv("VAULT_CACERT", str(bundle))
+    monkeypatch.setenv("CURL_CA_BUNDLE", str(tmp_path / "missing.pem"))
+    assert trusted() == ["Internal CA"]
@@ -1,11 +1,14 @@
 #!/usr/bin/env python3
 
+import json
 import os
+import platform
 import subprocess
 from collections import OrderedDict as ordereddict
 from shutil import copyfile
 
 import pytest
+import ruamel.yaml
 from datadiff.tools import assert_equal
 
 import src.vault as vault
@@ -111,6 +114,89 @@ def test_dec():
         'Done Decrypting',
     ]
 
+def test_migrate_and_view_packed(capsys):
+    os.environ["KVVERSION"] = "v2"
+    output = []
+    vault.print = lambda s : output.append(s)
+
+    vault.main(['migrate', './tests/test.yaml'])
+    vault.main(['view', './tests/test.yaml', '--layout', 'packed'])
+
+    assert output == ['Done Migrating']
+    decrypted = capsys.readouterr().out
+    assert 'password: changeme' not in decrypted
+    assert 'password: mariapass' in decrypted
+
+def test_metrics(tmp_path, capsys):
+    os.environ["KVVERSION"] = "v2"
+    vault.print = lambda s : None
+    metrics_file = str(tmp_path / "metrics.json")
+    openmetrics_file = str(tmp_path / "metrics.prom")
+
+    vault.main(['view', './tests/test.yaml', '--no-cache', '--metrics-file', metrics_file])
+    vault.main(['view', './tests/test.yaml', '--no-cache', '--profile', '--metrics-file', openmetrics_file])
+
+    with open(metrics_file) as json_file:
+        metrics = json.load(json_file)
+    assert metrics["action"] == "view"
+    assert set(metrics["phases"]) >= {"yaml_load", "vault_setup", "index", "vault", "git", "yaml_dump"}
+    assert metrics["vault"]["requests"] > 0
+    assert metrics["vault"]["latency_seconds"]["buckets"]["+Inf"] == metrics["vault"]["requests"]
+    assert metrics["cache"]["run_misses"] > 0
+
+    with open(openmetrics_file) as prom_file:
+        openmetrics = prom_file.read()
+    assert 'helm_vault_requests_total{action="view"}' in openmetrics
+    assert openmetrics.endswith("# EOF\n")
+
+    profile = capsys.readouterr().err
+    assert "Vault requests:" in profile
+    for output in (json.dumps(metrics), openmetrics, profile):
+        assert "mariapass" not in output
+        assert "secret/helm" not in output
+
+def test_dec_skips_current_file(tmp_path, monkeypatch):
+    os.environ["KVVERSION"] = "v2"
+    output = []
+    vault.print = lambda s : output.append(s)
+    yaml_file = str(tmp_path / "test.yaml")
+    copyfile("./tests/test.yaml", yaml_file)
+
+    vault.main(['dec', yaml_file])
+    assert os.path.exists(f"{yaml_file}.dec.manifest")
+
+    # Nothing changed, so the second run must not read any secret
+    reads, fetch_secret = [], vault.Vault.fetch_secret
+    monkeypatch.setattr(vault.Vault, "fetch_secret", lambda self, mount_point, path: reads.append(path) or fetch_secret(self, mount_point, path))
+    vault.main(['dec', yaml_file])
+
+    assert output == ['Done Decrypting', 'Done Decrypting']
+    assert reads == []
+
+    # The engine and --stream change the output, so either one decrypts again
+    for option in ['--engine=yaml', '--stream']:
+        vault.main(['dec', yaml_file, option])
+        assert reads
+        reads.clear()
+
+def test_dec_stream_multiple_documents(tmp_path):
+    os.environ["KVVERSION"] = "v2"
+    vault.print = lambda s : None
+    yaml_file = str(tmp_path / "test.yaml")
+    with open("./tests/test.yaml") as source, open(yaml_file, "w") as target:
+        values = source.read()
+        target.write(f"{values}---\n# Second document\n{values}")
+
+    vault.main(['dec', yaml_file, '--stream'])
+
+    with open(f"{yaml_file}.dec") as decrypted_file:
+        decrypted = decrypted_file.read()
+    first, second = decrypted.split("\n---\n")
+    assert "changeme" not in decrypted
+    assert "# Second document" in second
+    assert "## Official nextcloud image version" in first
+    assert first.count("password:") == second.count("password:") > 0
+
 def test_value_from_path():
     data = {
         "chapter1": {
@@ -138,6 +224,189 @@ def test_value_from_path():
         val = vault.value_from_path(data, "/chapter1/chapter1.1/bleh")
         assert "Missing secret value" in str(e.value)
 
+def test_dict_walker():
+    os.environ["KVVERSION"] = "v2"
+    args, _ = vault.parse_args(['dec', './tests/test.yaml']).parse_known_args(['dec', './tests/test.yaml'])
+    envs = vault.Envs(args)
+    data = vault.load_yaml("./tests/test.yaml")
+    secrets = [(key, path, full_path) for _, key, path, full_path in vault.dict_walker(envs.secret_delim, data, envs)]
+    assert secrets == [
+        ('password', '/nextcloud', None),
+        ('user', '/externalDatabase', '/secret/testdata/user'),
+        ('password', '/externalDatabase', '/secret//testdata/password'),
+        ('password', '/mariadb/db', None),
+    ]
+
+def test_placeholder_index(tmp_path):
+    os.environ["KVVERSION"] = "v2"
+    args, _ = vault.parse_args(['dec', './tests/test.yaml']).parse_known_args(['dec', './tests/test.yaml', '-e', 'prod'])
+    envs = vault.Envs(args)
+    envs.cache_dir = str(tmp_path)
+    data = vault.load_yaml("./tests/test.yaml")
+
+    index = vault.placeholder_index("./tests/test.yaml", data, envs)
+    assert index == [
+        [['nextcloud'], 'password', '/nextcloud', None],
+        [['externalDatabase'], 'user', '/externalDatabase', '/secret/testdata/user'],
+        [['externalDatabase'], 'password', '/externalDatabase', '/secret/{environment}/testdata/password'],
+        [['mariadb', 'db'], 'password', '/mariadb/db', None],
+    ]
+    assert len(os.listdir(tmp_path / "index")) == 1
+    assert vault.placeholder_index("./tests/test.yaml", data, envs) == index
+
+    secrets = list(vault.resolve_placeholders(index, data, envs))
+    assert secrets[2][1:] == ('password', '/prod/externalDatabase', '/secret//prod/testdata/password')
+    assert secrets[3][0] is data['mariadb']['db']
+
+def test_scan_spans():
+    os.environ["KVVERSION"] = "v2"
+    args, _ = vault.parse_args(['dec', './tests/test.yaml']).parse_known_args(['dec', './tests/test.yaml'])
+    envs = vault.Envs(args)
+    with open("./tests/test.yaml") as values_file:
+        text = values_file.read()
+
+    index = vault.scan_spans(text, envs)
+    assert [entry[:4] for entry in index] == vault.scan_placeholders(envs.secret_delim, envs.secret_template, vault.load_yaml("./tests/test.yaml"))
+    assert [text[start:end] for location, key, path, template_path, start, end in index] == [
+        'changeme', 'VAULT:/secret/testdata/user', 'VAULT:/secret/{environment}/testdata/password', 'changeme'
+    ]
+
+    # Files whose results could differ from the YAML engine's are left to it
+    assert vault.scan_spans("a:\n  - b: changeme\n", envs) == [[['a', 0], 'b', '/a', None, 10, 18]]
+    assert vault.scan_spans("a: &anchor\n  b: changeme\nc: *anchor\n", envs) is None
+    assert vault.scan_spans("a: 1\n---\nb: changeme\n", envs) is None
+    assert vault.scan_spans("1:\n  b: changeme\n", envs) is None
+    assert vault.scan_spans("a: !!str changeme\n", envs) is None
+    assert vault.scan_spans("a: [\n", envs) is None
+
+def test_splice_values():
+    os.environ["KVVERSION"] = "v2"
+    args, _ = vault.parse_args(['dec', './tests/test.yaml']).parse_known_args(['dec', './tests/test.yaml'])
+    envs = vault.Envs(args)
+    text = "# Comment\nuser:  'changeme'  # kept\nlist: [1,2]\nauth: {password: changeme}\nother: changeme\n"
+    index = vault.scan_spans(text, envs)
+    secrets = list(vault.splice_placeholders(index, envs))
+    for (holder, key, path, full_path), value in zip(secrets, ['admin', 'p@ss: "word"\n', 'changeme']):
+        holder[key] = value
+
+    spliced = vault.splice_values(text, index, secrets)
+    assert spliced == "# Comment\nuser:  admin  # kept\nlist: [1,2]\nauth: {password: \"p@ss: \\\"word\\\"\\n\"}\nother: changeme\n"
+
+    yaml = ruamel.yaml.YAML()
+    for value in ["plain", "true", "0123", "a: b", "- x", "#x", "trailing ", "", "line\nbreak", "\u00e9\u2028\x85\x7f", 5, None, {"a": [1]}]:
+        assert yaml.load(f"key: {vault.yaml_scalar(value)}\n")["key"] == value
+
+    # An unquoted placeholder is only kept for its own text, not with its first and last characters dropped
+    secrets[2][0][secrets[2][1]] = "hangem"
+    assert vault.splice_values(text, index, secrets).endswith("other: hangem\n")
+
+def test_splice_values_keeps_crlf(tmp_path):
+    os.environ["KVVERSION"] = "v2"
+    args, _ = vault.parse_args(['dec', './tests/test.yaml']).parse_known_args(['dec', './tests/test.yaml'])
+    envs = vault.Envs(args)
+    envs.cache_dir = str(tmp_path)
+    values_file = tmp_path / "values.yaml"
+    values_file.write_bytes(b"a: x\r\nauth:\r\n  password: changeme\r\nb: y\r\n")
+
+    [(text, index)] = vault.text_substitution([str(values_file)], "dec", envs)
+    secrets = list(vault.splice_placeholders(index, envs))
+    secrets[0][0]["password"] = "admin"
+
+    assert vault.splice_values(text, index, secrets) == "a: x\r\nauth:\r\n  password: admin\r\nb: y\r\n"
+
+def test_read_secret_coalesces():
+    os.environ["KVVERSION"] = "v2"
+    args, _ = vault.parse_args(['dec', './tests/test.yaml']).parse_known_args(['dec', './tests/test.yaml'])
+    envs = vault.Envs(args)
+    client = vault.Vault(args, envs)
+    fetched = []
+
+    def fetch_secret(mount_point, path):
+        fetched.append((mount_point, path))
+        return {"value": "secret"}
+    client.fetch_secret = fetch_secret
+
+    values = [client.read_secret("secret", "testdata/user")["value"] for _ in range(3)]
+
+    assert values == ["secret", "secret", "secret"]
+    assert fetched == [("secret", "testdata/user")]
+    assert (client.cache_hits, client.cache_misses) == (2, 1)
+
+def test_update_secret_check_and_set():
+    os.environ["KVVERSION"] = "v2"
+    args, _ = vault.parse_args(['enc', './tests/test.yaml']).parse_known_args(['enc', './tests/test.yaml'])
+    envs = vault.Envs(args)
+    client = vault.Vault(args, envs)
+    client.write_secret("secret", "testdata/cas", {"value": "one"}, cas=None)
+    assert client.update_secret("secret", "testdata/cas", {"value": "one"}) == "unchanged"
+
+    # Another writer bumps the version behind this run's cached read
+    other = vault.Vault(args, envs)
+    other.write_secret("secret", "testdata/cas", {"value": "two"}, cas=None)
+
+    assert client.update_secret("secret", "testdata/cas", {"value": "three"}) == "updated"
+    client.forget_secret("secret", "testdata/cas")
+    assert client.read_secret("secret", "testdata/cas") == {"value": "three"}
+
+@pytest.mark.skipif(platform.system() == "Windows", reason="No /dev/fd on Windows")
+def test_serve_values():
+    yaml = ruamel.yaml.YAML()
+    documents = [vault.load_yaml("./tests/test.yaml"), {"password": "secret"}]
+
+    paths, fds = vault.serve_values(yaml, documents)
+    try:
+        contents = [open(path).read() for path in paths]
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+    assert contents[0] == open("./tests/test.yaml").read()
+    assert contents[1] == "password: secret\n"
+
+def test_secret_cache(tmp_path):
+    pytest.importorskip("cryptography")
+    os.environ["KVVERSION"] = "v2"
+    os.environ["VAULT_CACHE_DIR"] = str(tmp_path)
+    try:
+        args, _ = vault.parse_args(['dec', './tests/test.yaml']).parse_known_args(['dec', './tests/test.yaml', '--cache-ttl', '60'])
+        envs = vault.Envs(args)
+    finally:
+        del os.environ["VAULT_CACHE_DIR"]
+    envs.cache_size = 1
+
+    cache = vault.SecretCache(envs, "token")
+    cache.put("secret", "testdata/user", "v2", {"value": "nextcloud"}, 3)
+    assert cache.get("secret", "testdata/user", "v2") == ({"value": "nextcloud"}, 3, True)
+    assert cache.get("secret", "testdata/user", "v1") is None
+    assert b"nextcloud" not in open(cache.filename("secret", "testdata/user", "v2"), "rb").read()
+
+    # Entries written with another token can't be read back
+    assert vault.SecretCache(envs, "other-token").get("secret", "testdata/user", "v2") is None
+
+    cache.put("secret", "testdata/password", "v2", {"value": "password"}, 1)
+    cache.evict()
+    assert len(os.listdir(tmp_path)) == 1
+
+def test_secret_cache_errors_are_misses(tmp_path, monkeypatch):
+    # A cache entry evicted by another run, or a cache that can't be written to, mustn't fail the secret read
+    pytest.importorskip("cryptography")
+    monkeypatch.setenv("KVVERSION", "v2")
+    monkeypatch.setenv("VAULT_CACHE_DIR", str(tmp_path))
+    args, _ = vault.parse_args(['dec', './tests/test.yaml']).parse_known_args(['dec', './tests/test.yaml', '--cache-ttl', '60'])
+    cache = vault.SecretCache(vault.Envs(args), "token")
+    cache.put("secret", "testdata/user", "v2", {"value": "nextcloud"}, 3)
+
+    def evicted(path, *args, **kwargs):
+        raise FileNotFoundError(path)
+    monkeypatch.setattr(vault.os, "utime", evicted)
+    assert cache.get("secret", "testdata/user", "v2") is None
+
+    def disk_full(path, *args, **kwargs):
+        raise OSError(28, "No space left on device", path)
+    monkeypatch.setattr(vault.os, "replace", disk_full)
+    cache.put("secret", "testdata/password", "v2", {"value": "password"}, 1)
+    assert os.listdir(tmp_path) == [os.path.basename(cache.filename("secret", "testdata/user", "v2"))]
+
 def test_clean():
     os.environ["KVVERSION"] = "v2"
     copyfile("./tests/test.yaml.dec", "./tests/test.yaml.dec.bak")